@@ -10,6 +10,7 @@ import matplotlib.ticker as ticker
 from Tkinter import *
 import Tkinter as Tk
 from GraphData import SQLIntervalView
+from chunkcache import shared_cache
 from DatePlot import *
 from datetime import datetime, timedelta
 import sqlite3 as sql
@@ -209,9 +210,6 @@ class HistoricalViewerApp:
                                  [x2+size*0.025, self.max_y],
                                  [x2+size*0.025, self.min_y],
                                  [x2, self.min_y]])
-        locator = KenLocator(7.8)
-        self.axes.xaxis.set_major_locator(locator)
-        self.axes.xaxis.set_major_formatter(KenFormatter(locator))
 
         self.axes.set_xlabel(format_span(self.start_date, self.end_date))
         self.nav_axes.set_xlabel(format_timedelta(self.end_date-self.start_date))
@@ -241,6 +239,10 @@ class HistoricalViewerApp:
         locator = KenLocator(7.8)
         self.nav_axes.xaxis.set_major_locator(locator)
         self.nav_axes.xaxis.set_major_formatter(KenFormatter(locator))
+
+        locator = KenLocator(7.8)
+        self.axes.xaxis.set_major_locator(locator)
+        self.axes.xaxis.set_major_formatter(KenFormatter(locator))
         
         self.update_data()
         self.update_bounds()
@@ -272,6 +274,7 @@ class HistoricalViewerApp:
             self.redraw()
         
     def redraw(self):
+        self.root.wm_title("Historical Data Viewer - cache: %s" % shared_cache.summary())
         self.figure.canvas.draw()
         self.nav_figure.canvas.draw()
 
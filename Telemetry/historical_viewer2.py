@@ -11,6 +11,7 @@ from matplotlib.transforms import BboxTransformTo
 from Tkinter import *
 import Tkinter as Tk
 from GraphData import SQLIntervalView
+from chunkcache import shared_cache
 from DatePlot import *
 from datetime import datetime, timedelta
 import sqlite3 as sql
@@ -290,6 +291,7 @@ class HistoricalViewerApp:
             self.redraw()
         
     def redraw(self):
+        self.root.wm_title("Historical Data Viewer - cache: %s" % shared_cache.summary())
         self.figure.canvas.draw()
         self.nav_figure.canvas.draw()
 
@@ -0,0 +1,340 @@
+"""
+Imports the CAN logs written to SD card by the Datalogger board into a
+telemetry database, so they can be browsed like anything recorded live.
+
+The Datalogger writes one line per CAN frame: the 11-bit id as 3 hex digits,
+the length as 2 hex digits and then each data byte as 2 hex digits, all
+separated by commas, e.g. "501,08,00,00,80,3F,00,00,20,41". Anything else on
+the card (section markers and the like) is skipped. Frames are decoded with
+the *.can.json descriptors, the same way the viewer decodes them live.
+
+The firmware doesn't record when frames arrived, so times are spread evenly
+over the log: between --start and --end if both are given, otherwise --period
+seconds apart from --start, or ending at --end, or ending when the log file
+was last modified. Times are UTC, given as YYYY-MM-DD HH:MM:SS[.ffffff].
+Each log is also added to the intervals table under its file name.
+
+The log is memory mapped and parsed in chunks with numpy, and every chunk is
+written and committed as one transaction.
+
+Usage: python import_datalogger.py [--database DB] [--start TIME] [--end TIME]
+                                   [--period SECONDS] LOG ...
+If no database is given, the one configured in config/general.cfg is used.
+"""
+import datetime
+import glob
+import json
+import mmap
+import os
+import re
+import sqlite3 as sql
+import sys
+import time
+from itertools import repeat
+
+import numpy as np
+
+from viewer import config
+from viewer import database
+from viewer.sample import TransparentMessageDecoder
+
+#Longest valid line: "SID,DLC" and 8 ",XX" bytes
+MAX_LINE = 6 + 3 * 8
+
+#Value of each ASCII hex digit, -1 for anything else
+HEX = np.full(256, -1, dtype=np.int16)
+for i, digit in enumerate("0123456789abcdef"):
+    HEX[ord(digit)] = HEX[ord(digit.upper())] = i
+
+COMMA = ord(",")
+
+#struct format characters and the numpy types they correspond to
+NUMPY_TYPES = {"b": "i1", "B": "u1", "?": "?", "h": "<i2", "H": "<u2",
+               "i": "<i4", "I": "<u4", "l": "<i4", "L": "<u4",
+               "q": "<i8", "Q": "<u8", "f": "<f4", "d": "<f8"}
+FORMAT_ITEM = re.compile(r"(\d*)([xcbB?hHiIlLqQfdsp])")
+
+def parse_time(text):
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f",
+                "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Can't parse time %r" % text)
+
+def layout_dtype(layout):
+    """
+    Returns a numpy structured dtype with the same layout as a MessageLayout's
+    struct, with fields named after its messages, or None if the format can't
+    be represented.
+    """
+    fmt = layout.struct.format.lstrip("<")
+    formats, offsets = [], []
+    offset = 0
+    position = 0
+    for match in FORMAT_ITEM.finditer(fmt):
+        if match.start() != position:
+            return None
+        position = match.end()
+        count = int(match.group(1) or 1)
+        code = match.group(2)
+        if code == "x":
+            offset += count
+        elif code in "sp":
+            formats.append("S%d" % count)
+            offsets.append(offset)
+            offset += count
+        else:
+            if code == "c":
+                dtype = np.dtype("S1")
+            else:
+                dtype = np.dtype(NUMPY_TYPES[code])
+            for j in xrange(count):
+                formats.append(dtype)
+                offsets.append(offset)
+                offset += dtype.itemsize
+    if position != len(fmt) or offset != layout.size:
+        return None
+    #Like the live decoder, ignore values without a name and vice versa
+    fields = zip(layout.names, formats, offsets)
+    if not fields:
+        return None
+    return np.dtype({"names": [name for (name, f, o) in fields],
+                     "formats": [f for (n, f, o) in fields],
+                     "offsets": [o for (n, f, o) in fields],
+                     "itemsize": layout.size})
+
+def split_lines(buf):
+    """
+    Parses a uint8 array of whole lines. Returns (line, sid, length, payload)
+    arrays for the well-formed frames, where line is the index of the frame's
+    line in buf and payload is an (n, 8) array of data bytes, and the total
+    number of lines.
+    """
+    ends = np.flatnonzero(buf == ord("\n"))
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts
+    #Tolerate CRLF line endings
+    if len(ends):
+        lengths -= buf[np.maximum(ends - 1, 0)] == ord("\r")
+
+    lines = np.flatnonzero((lengths >= 6) & (lengths <= MAX_LINE) & ((lengths - 6) % 3 == 0))
+    at = starts[lines]
+    digits = [HEX[buf[at + k]] for k in (0, 1, 2, 4, 5)]
+    sid = (digits[0] << 8) | (digits[1] << 4) | digits[2]
+    length = (digits[3] << 4) | digits[4]
+    size = (lengths[lines] - 6) // 3
+    ok = (buf[at + 3] == COMMA) & (length == size)
+    for d in digits:
+        ok &= d >= 0
+
+    payload = np.zeros((len(lines), 8), dtype=np.uint8)
+    for k in xrange(8):
+        has = np.flatnonzero(size > k)
+        if not len(has):
+            break
+        pos = at[has] + 7 + 3 * k
+        hi = HEX[buf[pos]]
+        lo = HEX[buf[pos + 1]]
+        ok[has] &= (buf[pos - 1] == COMMA) & (hi >= 0) & (lo >= 0)
+        payload[has, k] = (hi << 4) | lo
+
+    return lines[ok], sid[ok], length[ok], payload[ok], len(ends)
+
+def count_lines(mm, chunk_size):
+    lines = 0
+    for offset in xrange(0, len(mm), chunk_size):
+        chunk = np.frombuffer(mm, np.uint8, min(chunk_size, len(mm) - offset), offset)
+        lines += np.count_nonzero(chunk == ord("\n"))
+    return lines
+
+class Importer(object):
+    """
+    Decodes Datalogger logs and writes them to a telemetry database.
+
+    instance variables:
+        layouts  - CAN id -> (MessageLayout, numpy dtype) for the messages
+                   that can be decoded
+        frames   - number of frames decoded so far
+        rows     - number of rows written so far
+        bad      - number of lines that weren't frames
+        unknown  - CAN id -> number of frames without a usable descriptor
+        mismatch - CAN id -> number of frames whose length didn't match
+                   their descriptor
+    """
+    def __init__(self, connection, mappings, chunk_size=2**24):
+        self.connection = connection
+        self.writer = database.BulkWriter(connection)
+        self.chunk_size = chunk_size
+        self.layouts = {}
+        for id_, layout in TransparentMessageDecoder(mappings).layouts.items():
+            if layout.struct is not None:
+                dtype = layout_dtype(layout)
+                if dtype is not None:
+                    self.layouts[id_] = (layout, dtype)
+        self.frames = self.rows = self.bad = 0
+        self.unknown = {}
+        self.mismatch = {}
+
+    def import_log(self, path, start=None, end=None, period=None):
+        """
+        Imports the log at path, timing the frames as described above.
+        Returns the (start, end) times used.
+        """
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                lines = count_lines(mm, self.chunk_size)
+                if start is not None and end is not None:
+                    period = (end - start).total_seconds() / max(lines - 1, 1)
+                elif start is None:
+                    if end is None:
+                        end = datetime.datetime.utcfromtimestamp(os.fstat(f.fileno()).st_mtime)
+                    start = end - datetime.timedelta(seconds=period * max(lines - 1, 0))
+                end = start + datetime.timedelta(seconds=period * max(lines - 1, 0))
+
+                start_us = database.to_epoch_us(start)
+                period_us = period * 1e6
+                line = 0
+                offset = 0
+                while offset < size:
+                    stop = mm.rfind("\n", offset, offset + self.chunk_size) + 1
+                    if stop <= offset:
+                        #A line longer than a chunk can't be a frame, and
+                        #an unterminated last line was cut off by power loss
+                        stop = mm.find("\n", offset) + 1 or size
+                        self.bad += 1
+                        line += 1
+                        offset = stop
+                        continue
+                    buf = np.frombuffer(mm, np.uint8, stop - offset, offset)
+                    indices, sid, length, payload, count = split_lines(buf)
+                    epochs = start_us + np.round((line + indices) * period_us).astype(np.int64)
+                    self.write_frames(epochs, sid, length, payload)
+                    self.bad += count - len(indices)
+                    line += count
+                    offset = stop
+                    self.connection.commit()
+            finally:
+                mm.close()
+
+        self.connection.execute("INSERT INTO intervals (name, start, end) VALUES (?, ?, ?);",
+                                (os.path.basename(path), start, end))
+        self.connection.commit()
+        return start, end
+
+    def write_frames(self, epochs, sid, length, payload):
+        "Decodes a chunk of frames and writes their values"
+        self.frames += len(sid)
+        order = np.argsort(sid, kind="mergesort")
+        sid = sid[order]
+        ids, firsts = np.unique(sid, return_index=True)
+        lasts = np.append(firsts[1:], len(sid))
+        rows = []
+        get_signal = self.writer.signals.get
+        for id_, first, last in zip(ids.tolist(), firsts, lasts):
+            group = order[first:last]
+            if id_ not in self.layouts:
+                self.unknown[id_] = self.unknown.get(id_, 0) + len(group)
+                continue
+            layout, dtype = self.layouts[id_]
+            matching = group[length[group] == layout.size]
+            if len(matching) < len(group):
+                self.mismatch[id_] = self.mismatch.get(id_, 0) + len(group) - len(matching)
+            if not len(matching):
+                continue
+            values = payload[matching, :layout.size].copy().view(dtype)[:, 0]
+            times = epochs[matching].tolist()
+            for name in dtype.names:
+                column = values[name]
+                signal_id = get_signal(id_, name)
+                if column.dtype.kind == "f" and np.isfinite(column).all():
+                    encoded = zip(column.astype(np.float64).tolist(), repeat(None))
+                else:
+                    encoded = map(database.encode_datum, column.tolist())
+                rows.extend((signal_id, t, value, data)
+                            for (t, (value, data)) in zip(times, encoded))
+        self.rows += self.writer.write_rows(rows)
+
+def load_mappings():
+    mappings = []
+    for fname in glob.glob(os.path.join("config", "*.can.json")):
+        with open(fname) as f:
+            mappings.append(json.load(f))
+    return mappings
+
+def main(args):
+    options = {"--database": None, "--start": None, "--end": None, "--period": None}
+    paths = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in options:
+            if not args:
+                print __doc__
+                return 1
+            options[arg] = args.pop(0)
+        else:
+            paths.append(arg)
+    if not paths:
+        print __doc__
+        return 1
+
+    path = options["--database"]
+    if path is None:
+        path = config.find_options(os.path.join("config", "general.cfg"))["database"]
+    try:
+        start = parse_time(options["--start"]) if options["--start"] else None
+        end = parse_time(options["--end"]) if options["--end"] else None
+    except ValueError as e:
+        print e
+        return 1
+    period = float(options["--period"] or 0.01)
+    if start is not None and end is not None and len(paths) > 1:
+        print "--start and --end together can only be used with a single log"
+        return 1
+
+    connection = sql.connect(path, detect_types=(sql.PARSE_DECLTYPES
+                                                 | sql.PARSE_COLNAMES))
+    try:
+        connection.execute("PRAGMA journal_mode=WAL;")
+        connection.execute("PRAGMA synchronous=NORMAL;")
+        database.config_database(connection)
+        importer = Importer(connection, load_mappings())
+        ok = True
+        for log in paths:
+            if not os.path.exists(log):
+                print "Skipping %s - no such file" % log
+                ok = False
+                continue
+            begun = time.time()
+            frames, rows = importer.frames, importer.rows
+            interval = importer.import_log(log, start, end, period)
+            if interval is None:
+                print "Skipping %s - empty" % log
+                continue
+            print "Imported %s: %d frames, %d rows in %.1fs (%s to %s)" % (
+                log, importer.frames - frames, importer.rows - rows,
+                time.time() - begun, interval[0], interval[1])
+            #Consecutive logs follow on from each other
+            if start is not None:
+                start = interval[1] + datetime.timedelta(seconds=period)
+    finally:
+        connection.close()
+
+    if importer.bad:
+        print "Skipped %d lines that weren't frames" % importer.bad
+    for id_, count in sorted(importer.unknown.items()):
+        print "Skipped %d frames with id %#x - no usable descriptor" % (count, id_)
+    for id_, count in sorted(importer.mismatch.items()):
+        print "Skipped %d frames with id %#x - length doesn't match the descriptor" % (count, id_)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
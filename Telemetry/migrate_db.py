@@ -0,0 +1,57 @@
+"""
+Upgrades telemetry databases written by older versions of the viewer to the
+current schema. The viewer does this automatically on startup, but running
+it ahead of time avoids the wait on race day.
+
+Usage: python migrate_db.py [--vacuum] [database.db ...]
+If no databases are given, the one configured in config/general.cfg is used.
+"""
+import os
+import sqlite3 as sql
+import sys
+import time
+
+from viewer import config
+from viewer import database
+
+def migrate(path, vacuum=False):
+    if not os.path.exists(path):
+        print "Skipping %s - no such file" % path
+        return False
+
+    connection = sql.connect(path, detect_types=(sql.PARSE_DECLTYPES
+                                                 | sql.PARSE_COLNAMES))
+    try:
+        start = time.time()
+        def report(status):
+            print "  %s" % status
+
+        print "Upgrading %s" % path
+        old_version = database.upgrade_database(connection, progress=report)
+        if old_version >= database.SCHEMA_VERSION:
+            print "  Already at schema version %d" % old_version
+        else:
+            print "  Upgraded from schema version %d to %d in %.1fs" % (old_version,
+                                                                      database.SCHEMA_VERSION,
+                                                                      time.time() - start)
+        if vacuum:
+            print "  Reclaiming free space"
+            connection.execute("VACUUM;")
+    finally:
+        connection.close()
+    return True
+
+def main(args):
+    vacuum = "--vacuum" in args
+    paths = [arg for arg in args if arg != "--vacuum"]
+    if not paths:
+        options = config.find_options(os.path.join("config", "general.cfg"))
+        paths = [options["database"]]
+
+    ok = True
+    for path in paths:
+        ok = migrate(path, vacuum) and ok
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,61 @@
+"""
+Measures the throughput of the transparent serial stream decoding against
+synthetic CAN traffic, so that changes to the ingest path can be compared
+without needing the car.
+
+Usage: python stream_benchmark.py [megabytes]
+"""
+import random
+import struct
+import sys
+import time
+
+from viewer.sample import TransparentStreamDecoder, START_BYTE, escape
+
+START_CHAR = chr(START_BYTE)
+
+def make_traffic(size, seed=0):
+    "Generates roughly size bytes of escaped CAN frames with random payloads"
+    rng = random.Random(seed)
+    frames = []
+    total = 0
+    while total < size:
+        length = rng.randint(0, 8)
+        preamble = struct.pack("<H", (rng.randint(0, 0x7ff) << 4) | length)
+        payload = "".join(chr(rng.randint(0, 255)) for i in xrange(length))
+        frame = START_CHAR + escape(preamble + payload)
+        frames.append(frame)
+        total += len(frame)
+    return "".join(frames)
+
+def chunks(data, size=4096):
+    return [data[i:i+size] for i in xrange(0, len(data), size)]
+
+def measure(decode, reads):
+    start = time.clock()
+    for read in reads:
+        decode(read)
+    return time.clock() - start
+
+def main(megabytes=1.0):
+    data = make_traffic(int(megabytes * 2**20))
+    reads = chunks(data)
+    print "Decoding %d bytes in %d reads of 4096 bytes" % (len(data), len(reads))
+
+    bulk = TransparentStreamDecoder()
+    bytewise = TransparentStreamDecoder()
+    if "".join(map(bulk.decode, reads)) != "".join(map(bytewise.decode_bytewise, reads)):
+        print "Error: bulk and bytewise decoding disagree!"
+        return 1
+
+    for name, decode in [("bytewise", TransparentStreamDecoder().decode_bytewise),
+                         ("bulk", TransparentStreamDecoder().decode)]:
+        elapsed = measure(decode, reads)
+        print "%-10s %8.3fs %10.2f MB/s" % (name, elapsed, len(data) / elapsed / 2**20)
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main(float(sys.argv[1])))
+    else:
+        sys.exit(main())
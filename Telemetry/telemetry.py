@@ -1,18 +1,24 @@
 import os, sys
 
+import collections
 import datetime
 import glob
 import math
 import json
-from Queue import Queue, PriorityQueue
+import time
 import sqlite3 as sql
 import struct
 
 from PySide import QtGui, QtCore
 
 from viewer import config
+from viewer import database
+from viewer.logs import LogFileWriter, RateLimiter, message_source
 
 from viewer.ports import ask_for_port
+from viewer.sharedbus import IngestProcess
+from viewer.fanout import FanoutServer
+from viewer.replay import CaptureRecorder, ReplayPort
 from viewer.sample import *
 #from viewer.sample import XOMBIEDecoder, XOMBIEStream, DataSource
 from viewer.util import link, find_icon
@@ -23,6 +29,28 @@ from viewer.LiveGraph import LiveGraphTabView
 from viewer.BatteryStatus import BatteryScatterPlotTabView
 from viewer.SignalWidget import SignalTreeWidget
 
+def parse_arguments(args):
+    """
+    Picks the viewer's own options out of the command line:
+        --replay FILE   read from a capture file instead of a serial port
+        --speed N       replay at N times real time, or 0 for as fast as
+                        possible (default 1)
+        --loop          start the replay again when it reaches the end
+        --capture FILE  record everything read from the port to FILE
+    Anything else is left for Qt.
+    """
+    options = {"replay": None, "speed": 1.0, "loop": False, "capture": None}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ("--replay", "--capture") and args:
+            options[arg[2:]] = args.pop(0)
+        elif arg == "--speed" and args:
+            options["speed"] = float(args.pop(0))
+        elif arg == "--loop":
+            options["loop"] = True
+    return options
+
 def find_source(name):
     if app.xombie_thread.isRunning():
         return app.xombie_thread.stream.get_data(name)
@@ -32,32 +60,47 @@ def find_source(name):
 class ConsoleLogger:
     """
     Implements minimal logging.logger functionality and displays to the console
-    instead of writing to a file by putting messages into a queue which is
-    periodically copied to the console.
+    by putting messages into a queue which is periodically copied to the
+    console. The queue is a deque with a maximum length, so if the console
+    falls behind only the newest messages are kept. Messages are also
+    written to the day's log file by a LogFileWriter.
+
+    Messages logged with a source, like each packet the stream decodes, are
+    rate limited per source; summarize logs how many were received from
+    each source that went over its limit.
     """
     def __init__(self, queue):
         self.queue = queue
-        self.log = open("%s.log" % datetime.date.today().strftime("%Y-%m-%d"), "a")
+        self.limiter = RateLimiter()
+        self.file = LogFileWriter()
+        self.file.start()
 
-    def info(self, msg, *args, **kwargs):
+    def log(self, template, msg, args, kwargs):
+        source = message_source(kwargs)
+        if source is not None and not self.limiter.allow(source):
+            return
         formatted = (msg % kwargs) if kwargs else (msg % args)
-        self.queue.put(formatted)
-        self.log.write(formatted + "\n")
+        self.queue.append(template % formatted)
+        self.file.write(formatted)
+
+    def info(self, msg, *args, **kwargs):
+        self.log("%s", msg, args, kwargs)
 
     def warning(self, msg, *args, **kwargs):
-        formatted = (msg % kwargs) if kwargs else (msg % args)
-        self.queue.put('<font color="orange">%s</font>' % formatted)
-        self.log.write(formatted + "\n")
+        self.log('<font color="orange">%s</font>', msg, args, kwargs)
 
     def error(self, msg, *args, **kwargs):
-        formatted = (msg % kwargs) if kwargs else (msg % args)
-        self.queue.put('<font color="red">%s</font>' % formatted)
-        self.log.write(formatted + "\n")
+        self.log('<font color="red">%s</font>', msg, args, kwargs)
 
     def critical(self, msg, *args, **kwargs):
-        formatted = (msg % kwargs) if kwargs else (msg % args)
-        self.queue.put('<font color="red">%s</font>' % formatted)
-        self.log.write(formatted + "\n")
+        self.log('<font color="red">%s</font>', msg, args, kwargs)
+
+    def summarize(self):
+        for line in self.limiter.summaries():
+            self.info("%s", line)
+
+    def close(self):
+        self.file.close()
 
 class XOMBIEThread(QtCore.QThread):
     """
@@ -65,14 +108,15 @@ class XOMBIEThread(QtCore.QThread):
     On startup, it launches the additional asynchronous XOMBIEStream thread
     and collects data from it using callbacks.
 
-    Data from the XOMBIEStream is immediately logged and periodically committed
-    to disk. Separately, data queues are maintained on the stream for each
-    signal, from which the XOMBIE thread pushes data to DataSource objects.
+    Data from the XOMBIEStream is immediately handed off to the database
+    writer thread, which inserts and commits it. Separately, data queues are
+    maintained on the stream for each signal, from which the XOMBIE thread
+    pushes data to DataSource objects.
 
     instance variables:
-        connection - the DB-API connection object for the SQLite database, which
-                     we use to commit data as it is received.
         stream     - the XOMBIEStream which we collect data from
+        writer     - the DatabaseWriter which persists each batch of decoded
+                     data on its own thread
         sources     - really just DataSource.sources
 
         checking_heartbeat - indicates if we're waiting on a heartbeat response
@@ -80,7 +124,6 @@ class XOMBIEThread(QtCore.QThread):
         heartbeat_timer    - timer for one-shot five-second waiting for a response
 
         timer         - the main timer for XOMBIEStream event polling handling
-        commit_timer  - the timer for periodic commits
         
     method summary:
         setup           - takes care of all thread-specific setup
@@ -93,17 +136,15 @@ class XOMBIEThread(QtCore.QThread):
                           our heartbeat request
         mark_heartbeat  - callback to record any heartbeat responses
 
-        insert_data     - Adds a single data point to the database
-        commit_data     - Commits data to the database
         shutdown        - Handles closing down the XOMBIEStream
     """
     shutdown_event_type = QtCore.QEvent.Type(QtCore.QEvent.registerEventType())
-    def __init__(self, conn, stream, parent=None):
+    def __init__(self, writer, stream, parent=None):
         QtCore.QThread.__init__(self, parent)
         self.stream = stream
-        self.connection = conn
+        self.writer = writer
 
-        self.timer = self.commit_timer = None
+        self.timer = None
         self.should_query = False
         self.should_test = False
         self.should_reassociate = False
@@ -122,9 +163,6 @@ class XOMBIEThread(QtCore.QThread):
         link(self.heartbeat_timer.timeout, self.check_timeout)
         
         self.timer = QtCore.QTimer()
-        self.commit_timer = QtCore.QTimer()
-        
-        link(self.commit_timer.timeout, self.commit_data)
         link(self.timer.timeout, self.process)
 
         self.stream.add_callback(0x85, self.mark_heartbeat)
@@ -132,7 +170,6 @@ class XOMBIEThread(QtCore.QThread):
         self.stream.add_callback(0xE2, self.print_test)
         self.stream.start()
 
-        self.commit_timer.start(5000)
         self.timer.start(100)
 
     def process(self):
@@ -202,11 +239,7 @@ class XOMBIEThread(QtCore.QThread):
                     self.stream.send_no_ack("\x84")
                     self.heartbeat_timer.start(5000)
             else:
-                cursor = self.connection.cursor()
-                while not self.stream.msg_queue.empty():
-                    id_, name, t, datum = self.stream.msg_queue.get_nowait()
-                    self.insert_data(cursor, id_, name, t, datum)
-                cursor.close()
+                self.writer.drain(self.stream.msg_queue)
                 for source in self.stream.data_table.values():
                     source.pull()
 
@@ -241,13 +274,6 @@ class XOMBIEThread(QtCore.QThread):
 
     def print_test(self, msg):
         self.stream.logger.info("Got test message: %s" % msg)
-
-    def insert_data(self, cursor, id_, name, t, data):
-        cmd = "INSERT INTO data(id, name, time, data) VALUES (?,?,?,?)"
-        cursor.execute(cmd, (id_, name, t, json.dumps(data, ensure_ascii=False)))
-
-    def commit_data(self):
-        self.connection.commit()
     
     def event(self, evt):
         if evt.type() == self.shutdown_event_type:
@@ -258,7 +284,6 @@ class XOMBIEThread(QtCore.QThread):
             return QtCore.QThread.event(self, evt)
 
     def shutdown(self):
-        self.commit_timer.stop()
         self.timer.stop()
         
         if self.stream is not None:
@@ -268,41 +293,26 @@ class XOMBIEThread(QtCore.QThread):
 
 class TransparentThread(QtCore.QThread):
     shutdown_event_type = QtCore.QEvent.Type(QtCore.QEvent.registerEventType())
-    def __init__(self, conn, stream, parent=None):
+    def __init__(self, writer, stream, parent=None):
         QtCore.QThread.__init__(self, parent)
         self.stream = stream
-        self.connection = conn
+        self.writer = writer
 
-        self.timer = self.commit_timer = None
+        self.timer = None
 
         link(self.started, self.setup)
     
     def setup(self):
         self.timer = QtCore.QTimer()
-        self.commit_timer = QtCore.QTimer()
-        
-        link(self.commit_timer.timeout, self.commit_data)
         link(self.timer.timeout, self.process)
-
-        self.commit_timer.start(5000)
         self.timer.start(500)
 
     def process(self):
         self.stream.process()
-        cursor = self.connection.cursor()
-        while not self.stream.msg_queue.empty():
-            id_, name, t, datum = self.stream.msg_queue.get_nowait()
-            self.insert_data(cursor, id_, name, t, datum)
-        cursor.close()
+        if self.writer is not None:
+            self.writer.drain(self.stream.msg_queue)
         for source in self.stream.data_table.values():
             source.pull()
-
-    def insert_data(self, cursor, id_, name, t, data):
-        cmd = "INSERT INTO data(id, name, time, data) VALUES (?,?,?,?)"
-        cursor.execute(cmd, (id_, name, t, json.dumps(data, ensure_ascii=False)))
-
-    def commit_data(self):
-        self.connection.commit()
     
     def event(self, evt):
         if evt.type() == self.shutdown_event_type:
@@ -313,7 +323,6 @@ class TransparentThread(QtCore.QThread):
             return QtCore.QThread.event(self, evt)
 
     def shutdown(self):
-        self.commit_timer.stop()
         self.timer.stop()
         
         if self.stream is not None:
@@ -322,16 +331,18 @@ class TransparentThread(QtCore.QThread):
         self.quit()
 
 
-def tableExists(conn, name):
-    cur = conn.cursor()
-    cur.execute('SELECT name FROM sqlite_master where name = ?;', (name,))
-    exists = cur.fetchone() != None
-    cur.close()
-    return exists
-
 class TelemetryApp(QtGui.QApplication):
     def setup(self):
-        port = ask_for_port(os.path.join("config", "ports.cfg"))
+        options = parse_arguments(sys.argv[1:])
+        if options["replay"] is not None:
+            print "Replaying %s at %sx" % (options["replay"], options["speed"] or "unthrottled ")
+            port = ReplayPort(options["replay"], options["speed"], options["loop"])
+        else:
+            port = ask_for_port(os.path.join("config", "ports.cfg"))
+        if port is not None and options["capture"] is not None:
+            print "Recording serial data to %s" % options["capture"]
+            port = CaptureRecorder(port, options["capture"])
+
         if port is None:
             self.start_thread = False
             print "Running in debug mode - no serial port connected"
@@ -346,21 +357,42 @@ class TelemetryApp(QtGui.QApplication):
                                                     | sql.PARSE_COLNAMES))
 
         self.config_database(self.connection, False)
+        #WAL lets this connection read while the writer thread commits
+        self.connection.execute("PRAGMA journal_mode=WAL;")
         
         desc_sets = self.load_can_descriptors()
+        self.signals = database.SignalTable(self.connection)
+        self.signals.add_descriptors(desc_sets)
         decoder = TransparentMessageDecoder([desc_set for (source, desc_set) in desc_sets])
         #decoder = XOMBIEDecoder([desc_set for (source, desc_set) in desc_sets])
 
         self.window = TelemetryViewerWindow(self, "Telemetry Viewer", desc_sets)
 
-        if self.start_thread:
-            stream = TransparentStream(decoder, self.window.logger, port)
-##            stream = XOMBIEStream(port, decoder, self.window.logger,
-##                                  self.general_options["board_address"])
-            
+        self.db_writer = None
+        self.fanout = None
+        if self.start_thread and self.separate_ingest:
+            #Decoding and logging happen in their own process, which shares
+            #the live data with the viewer through memory-mapped rings
+            print "Starting ingest process"
+            stream = IngestProcess(port, self.general_options["database"],
+                                   [desc_set for (source, desc_set) in desc_sets],
+                                   self.window.logger, self.fanout_address)
+            stream.start()
         else:
-            stream = None
-        self.xombie_thread = TransparentThread(self.connection, stream)
+            if self.start_thread:
+                stream = TransparentStream(decoder, self.window.logger, port)
+##                stream = XOMBIEStream(port, decoder, self.window.logger,
+##                                      self.general_options["board_address"])
+                if self.fanout_address is not None:
+                    self.fanout = FanoutServer(self.fanout_address, self.window.logger)
+                    self.fanout.start()
+                    stream.fanout = self.fanout
+            else:
+                stream = None
+            self.db_writer = database.DatabaseWriter(self.general_options["database"],
+                                                     self.window.logger)
+            self.db_writer.start()
+        self.xombie_thread = TransparentThread(self.db_writer, stream)
                 
         link(self.lastWindowClosed, self.closeEvent)
 
@@ -379,18 +411,9 @@ class TelemetryApp(QtGui.QApplication):
 
     def config_database(self, conn, drop_tables=False):
         "Sets up the database with the intervals and data tables"
-        cursor = conn.cursor()
-        if tableExists(conn, "intervals") and drop_tables:
-            cursor.execute("DROP TABLE intervals;")
-        if not tableExists(conn, "intervals"):
-            cursor.execute("CREATE TABLE intervals (name text, start timestamp, end timestamp);")
-
-        if tableExists(conn, "data") and drop_tables:
-            cursor.execute("DROP TABLE data;")
-        if not tableExists(conn, "data"):
-            cursor.execute("CREATE TABLE data (id integer, name text, time timestamp, data text);")
-        conn.commit()
-        cursor.close()
+        def report(status):
+            print "Upgrading database: %s" % status
+        database.config_database(conn, drop_tables, progress=report)
 
     def load_can_descriptors(self):
         "Looks for all of the *.can.json files and compiles them into a list of descriptors"
@@ -408,6 +431,15 @@ class TelemetryApp(QtGui.QApplication):
 
     def read_config(self):
         self.general_options = config.find_options(os.path.join("config", "general.cfg"))
+        self.separate_ingest = (self.general_options.get("separate_process", "false").lower()
+                                in ("true", "yes", "1"))
+        DataSource.reorder_window = float(self.general_options.get("reorder_window",
+                                                                   DataSource.reorder_window))
+        fanout_port = int(self.general_options.get("fanout_port", 0))
+        if fanout_port:
+            self.fanout_address = (self.general_options.get("fanout_host", ""), fanout_port)
+        else:
+            self.fanout_address = None
         try:
             f = open(os.path.join("config", "tabs.config.json"), "r")
             self.tab_descs = json.load(f)
@@ -426,6 +458,14 @@ class TelemetryApp(QtGui.QApplication):
                 self.xombie_thread.wait()
                 print "\r" + "TT shutdown successfully".ljust(50)
 
+            if self.fanout is not None:
+                self.fanout.close()
+
+            if self.db_writer is not None:
+                print        "Writing remaining data to disk".ljust(50),
+                self.db_writer.close()
+                print "\r" + "Database writer shutdown successfully".ljust(50)
+
             if self.connection is not None:
                 print        "Commiting remaining data to disk".ljust(50),
                 self.connection.commit()
@@ -434,6 +474,7 @@ class TelemetryApp(QtGui.QApplication):
                 print "\r" + "SQLite connection shutdown successfully.".ljust(50)
             
         finally:
+            self.window.logger.close()
             print ("Writing configuration information to '%s'" % "tabs.config.json").ljust(50)
             try:
                 f = open(os.path.join("config", "tabs.config.json"), "w+")
@@ -447,6 +488,19 @@ class TelemetryApp(QtGui.QApplication):
                 self.quit()
 
 class TelemetryViewerWindow(QtGui.QMainWindow):
+    """
+    The main window. The active tab is updated and redrawn from
+    redraw_timer, but tabs only draw when their data or limits have
+    changed. The timer's interval follows a running average of how long
+    those draws take, so that drawing uses at most about redraw_load of
+    the GUI thread, within min_redraw_interval and max_redraw_interval
+    milliseconds.
+    """
+    min_redraw_interval = 100
+    max_redraw_interval = 1000
+    redraw_load = 0.25
+    max_console_lines = 1000
+
     def __init__(self, application, title, desc_sets):
         QtGui.QMainWindow.__init__(self)
 
@@ -476,7 +530,7 @@ class TelemetryViewerWindow(QtGui.QMainWindow):
 
         
 
-        self.message_queue = Queue()
+        self.message_queue = collections.deque(maxlen=self.max_console_lines)
         self.logger = ConsoleLogger(self.message_queue)
         self.console_timer = QtCore.QTimer(self)
         self.redraw_timer = QtCore.QTimer(self)
@@ -485,8 +539,9 @@ class TelemetryViewerWindow(QtGui.QMainWindow):
         link(self.console_timer.timeout, self.update_console)
         link(self.redraw_timer.timeout, self.redraw)
 
+        self.redraw_cost = 0.0
         self.console_timer.start(50)
-        self.redraw_timer.start(100)
+        self.redraw_timer.start(self.min_redraw_interval)
 
     def json_friendly(self):
         return [(self.tabWidget.tabText(i), self.tabWidget.widget(i).json_friendly())
@@ -496,9 +551,19 @@ class TelemetryViewerWindow(QtGui.QMainWindow):
         "Updates and redraws the active plot"
         now = datetime.datetime.utcnow()
         plot = self.tabWidget.currentWidget()
-        if plot is not None:
-            plot.update_view(now)
-            plot.redraw()
+        if plot is None:
+            return
+
+        start = time.time()
+        plot.update_view(now)
+        if plot.redraw():
+            cost = time.time() - start
+            self.redraw_cost = 0.8 * self.redraw_cost + 0.2 * cost
+            interval = int(1000 * self.redraw_cost / self.redraw_load)
+            interval = max(self.min_redraw_interval,
+                           min(self.max_redraw_interval, interval))
+            if interval != self.redraw_timer.interval():
+                self.redraw_timer.setInterval(interval)
 
     def _ui_setup(self):
         "Largely autogenerated layout code to setup interface"
@@ -541,6 +606,8 @@ class TelemetryViewerWindow(QtGui.QMainWindow):
         #Debugging Console
         self.console = QtGui.QTextEdit(self.vsplitter)
         self.console.setReadOnly(True)
+        #Drop the oldest lines rather than growing without limit
+        self.console.document().setMaximumBlockCount(self.max_console_lines)
         sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
         sizePolicy.setHorizontalStretch(0)
         sizePolicy.setVerticalStretch(0)
@@ -643,6 +710,10 @@ class TelemetryViewerWindow(QtGui.QMainWindow):
         self.statusBar.setObjectName("statusBar")
         self.setStatusBar(self.statusBar)
 
+        self.late_label = QtGui.QLabel(self.statusBar)
+        self.statusBar.addPermanentWidget(self.late_label)
+        self.late_count = None
+
     def setup_tabs(self, descs):
         if not descs:
             return
@@ -683,8 +754,9 @@ class TelemetryViewerWindow(QtGui.QMainWindow):
 
     def update_console(self):
         "Pull any messages from the message queue and display them on the console"
-        while not self.message_queue.empty():
-            self.console.append(self.message_queue.get_nowait())
+        self.logger.summarize()
+        for message in database.drain_queue(self.message_queue):
+            self.console.append(message)
         self.update_colors()
         
     def make_new_tab(self):
@@ -720,9 +792,28 @@ class TelemetryViewerWindow(QtGui.QMainWindow):
         if not app.xombie_thread.isRunning():
             return
         received_times = []
+        late = []
         for name, source in app.xombie_thread.stream.data_table.items():
             received_times.append((name, source.last_received))
+            if source.late:
+                late.append((source.late, name))
         self.canTreeWidget.update_colors(received_times)
+        self.update_late_label(late)
+
+    def update_late_label(self, late):
+        "Shows how many samples arrived too late to be plotted in order"
+        count = sum(n for (n, name) in late)
+        if count == self.late_count:
+            return
+        self.late_count = count
+        if count:
+            self.late_label.setText("Late samples: %d" % count)
+            late.sort(reverse=True)
+            self.late_label.setToolTip("\n".join("%s: %d" % (name, n)
+                                                 for (n, name) in late[:20]))
+        else:
+            self.late_label.setText("")
+            self.late_label.setToolTip("")
 
 if __name__ == "__main__":
     app = TelemetryApp(sys.argv)
@@ -0,0 +1,66 @@
+"""
+Regression tests for finding and unescaping frames in the transparent serial
+stream.
+
+Usage: python test_sample.py
+"""
+import struct
+import unittest
+
+from viewer.sample import TransparentMessageDecoder, TransparentStream, START_BYTE, escape
+
+MAPPING = {"0x402": {"name": "Bus Measurement", "format": "ff",
+                     "messages": [["Bus Voltage", "volts", ""],
+                                  ["Bus Current", "amperes", ""]]}}
+
+class ChunkedPort(object):
+    "Hands out data in fixed-size reads, like a serial port would"
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def read(self, size):
+        size = min(size, self.size)
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def close(self):
+        pass
+
+class NullLogger(object):
+    def info(self, msg, *args, **kwargs):
+        pass
+
+def frame(id_, payload):
+    preamble = struct.pack("<H", (id_ << 4) | len(payload))
+    return chr(START_BYTE) + escape(preamble + payload)
+
+class TransparentStreamTest(unittest.TestCase):
+    payloads = ["\x01\x02\xe7\x04\x05\x06\x07\x08",
+                "\x75\x75\xe7\xe7\x75\xe7\x00\x75",
+                "\xe7\x00\x00\x00\x75\x00\x00\x00"]
+
+    def receive(self, data, size):
+        stream = TransparentStream(TransparentMessageDecoder([MAPPING]),
+                                   NullLogger(), ChunkedPort(data, size))
+        for i in xrange(len(data) // size + 1):
+            stream.process()
+        return [datum for (ts, datum) in stream.get_data("0x402:Bus Voltage").queue]
+
+    def expected(self):
+        return [struct.unpack("<ff", payload)[0] for payload in self.payloads]
+
+    def test_escaped_bytes_in_payload(self):
+        data = "".join(frame(0x402, payload) for payload in self.payloads)
+        #The last frame only ends once the next one starts
+        data += chr(START_BYTE)
+        self.assertEqual(self.receive(data, 4096), self.expected())
+
+    def test_escapes_split_across_reads(self):
+        data = "".join(frame(0x402, payload) for payload in self.payloads)
+        data += chr(START_BYTE)
+        for size in (1, 2, 3, 5):
+            self.assertEqual(self.receive(data, size), self.expected())
+
+if __name__ == "__main__":
+    unittest.main()
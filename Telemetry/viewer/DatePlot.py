@@ -7,6 +7,8 @@ import matplotlib.dates as mdates
 import numpy as np
 import matplotlib.path as mpath
 
+from decimate import envelope
+
 to_ordinal = mdates._to_ordinalf
 class UTC(datetime.tzinfo):
     def utcoffset(self, dt):
@@ -20,6 +22,17 @@ class UTC(datetime.tzinfo):
 
 utc = UTC()
 
+#matplotlib date ordinal of 1970-01-01 00:00 UTC
+EPOCH_ORDINAL = to_ordinal(datetime.datetime(1970, 1, 1))
+
+def epoch_to_ordinal(seconds):
+    "Converts seconds since the Unix epoch (scalar or array) to date ordinals"
+    return np.asarray(seconds, np.float_) / 86400.0 + EPOCH_ORDINAL
+
+def ordinal_to_epoch(x):
+    "Inverse of epoch_to_ordinal"
+    return (np.asarray(x, np.float_) - EPOCH_ORDINAL) * 86400.0
+
 def from_ordinal(x):
     return mdates._from_ordinalf(x).astimezone(utc).replace(tzinfo=None)
 
@@ -63,8 +76,17 @@ def find_aligned_datetime_after(dt, s):
     return find_aligned_datetime_before(dt, s) + datetime.timedelta(seconds = s)
 
 class KenLocator(ticker.Locator):
+    """
+    Places ticks on round times, choosing the smallest interval from
+    possible_time_intervals that gives at most max_ticks ticks.
+
+    The ticks are memoized on the axis' view interval, so a locator can be
+    kept on an axis for good and only does any work when the view changes.
+    """
     def __init__(self, max_ticks):
         self.max_ticks = max_ticks
+        self.memo_key = None
+        self.memo_ticks = None
 
     def viewlim_to_dt(self):
         vmin, vmax = self.axis.get_view_interval()
@@ -77,6 +99,10 @@ class KenLocator(ticker.Locator):
         """Returns a list of aligned datetime objects between start and end."""
         if max_ticks is None:
             max_ticks = self.max_ticks
+        key = tuple(self.axis.get_view_interval()) + (max_ticks,)
+        if key == self.memo_key:
+            return list(self.memo_ticks)
+
         start, end = self.viewlim_to_dt()
         time_interval = end - start
         #Get a list of number of tickmarks an interval would use
@@ -97,16 +123,35 @@ class KenLocator(ticker.Locator):
         while dt_tickmark < end:
             aligned_datetimes.append(dt_tickmark)
             dt_tickmark = dt_tickmark + datetime.timedelta(seconds = interval_to_use)
+
+        self.memo_key = key
+        self.memo_ticks = tuple(aligned_datetimes)
         return aligned_datetimes
 
 class KenFormatter(ticker.FixedFormatter):
+    """
+    Labels the ticks of a KenLocator. The labels are built in set_locs,
+    which matplotlib calls before labelling the ticks, and only rebuilt
+    when the view interval has changed. Formatted labels are cached by tick time and
+    format, since a scrolling plot keeps showing the same ticks.
+    """
+    max_cached_labels = 1024
     def __init__(self, locator):
         self.locator = locator
-        ticker.FixedFormatter.__init__(self, self.make_labels())
+        self.labels_key = None
+        self.label_cache = {}
+        ticker.FixedFormatter.__init__(self, [])
+
+    def set_locs(self, locs):
+        self.locs = locs
+        if tuple(self.locator.axis.get_view_interval()) != self.labels_key:
+            self.seq = self.make_labels()
 
-    def get_formats(self, twelve_hour=True, quote_format=True, truncation=True):
+    def get_formats(self, twelve_hour=True, quote_format=True, truncation=True,
+                    ticks=None):
         start, end = self.locator.viewlim_to_dt()
-        ticks = self.locator.make_ticks()
+        if ticks is None:
+            ticks = self.locator.make_ticks()
 
         labels = []
         skip_30_seconds = False
@@ -142,37 +187,91 @@ class KenFormatter(ticker.FixedFormatter):
         return labels
 
     def make_labels(self):
+        self.labels_key = tuple(self.locator.axis.get_view_interval())
         ticks = self.locator.make_ticks()
-        formats = self.get_formats()
-        return [tick.strftime(fmt) for (tick, fmt) in zip(ticks, formats)]
+        formats = self.get_formats(ticks=ticks)
+        cache = self.label_cache
+        if len(cache) > self.max_cached_labels:
+            cache.clear()
+        labels = []
+        for tick, fmt in zip(ticks, formats):
+            label = cache.get((tick, fmt))
+            if label is None:
+                label = cache[(tick, fmt)] = tick.strftime(fmt)
+            labels.append(label)
+        return labels
 
 class DatetimeCollection(LineCollection):
     """
     A LineCollection that expects samples with datetimes as x-coordinates
-    and converts them to ordinal values internally."""
+    and converts them to ordinal values internally.
+
+    Each segment may be:
+        * an Nx2 NumPy array already in ordinal values, used as-is
+        * an (xs, ys) pair of arrays, where xs is datetime64 or ordinals
+        * a sequence of (datetime, value) samples
+
+    Samples are converted in one vectorized step.
+
+    If set_decimation has been called, each segment is reduced to a min/max
+    envelope over the given x range before it is turned into a path.
+    """
+    decimation = None
+    def set_decimation(self, x0, x1, buckets):
+        """
+        Decimates segments to buckets min/max buckets between the ordinals
+        x0 and x1. Takes effect on the next set_segments.
+        """
+        self.decimation = (x0, x1, buckets)
+
     def set_segments(self, segments):
-        if not segments or segments == [[]]:
+        if not segments or (len(segments) == 1 and len(segments[0]) == 0):
             self._paths = []
             return
-        
+
         np_segments = []
         for seg in segments:
-            if not np.ma.isMaskedArray(seg):
-                seg = np.asarray([(to_ordinal(x), y) for (x, y) in seg], np.float_)
-##                seg = np.array(((to_ordinal(x), y) for (x, y) in seg))
-
+            if isinstance(seg, np.ndarray):
+                pass
+            elif isinstance(seg, tuple) and len(seg) == 2 and isinstance(seg[0], np.ndarray):
+                xs, ys = seg
+                seg = np.column_stack((to_ordinals(xs), ys))
+            else:
+                seg = convert_samples(seg)
             np_segments.append(seg)
+
+        if self.decimation is not None:
+            x0, x1, buckets = self.decimation
+            np_segments = [envelope(seg, x0, x1, buckets) for seg in np_segments]
         if self._uniform_offsets is not None:
             np_segments = self._add_offsets(np_segments)
         self._paths = [mpath.Path(seg) for seg in np_segments]
-##    def set_segments(self, segments):
-##        if segments == [[]] or segments == []:
-##            self._paths = []
-##            LineCollection.set_segments(self, None)
-##            return
-##        
-##        images = [[(to_ordinal(x), y) for (x, y) in line] for line in segments]
-##        LineCollection.set_segments(self, images)
+
+def to_ordinals(xs):
+    """
+    Converts an array of datetime64 values or a sequence of naive UTC
+    datetimes to date ordinals in one vectorized step. Float arrays are
+    assumed to be ordinals already.
+    """
+    if not isinstance(xs, np.ndarray):
+        #Going through an object array is about twice as fast as letting
+        #NumPy parse the list as datetime64 directly
+        xs = np.array(xs, dtype=object)
+    if xs.dtype.kind == 'f':
+        return xs
+    us = xs.astype("datetime64[us]").astype(np.int64)
+    return us / 86400e6 + EPOCH_ORDINAL
+
+def convert_samples(samples):
+    """
+    Converts a sequence of (datetime, value) samples to an Nx2 array of
+    ordinals and values
+    """
+    if not len(samples):
+        return np.empty((0, 2), np.float_)
+    xs = to_ordinals([x for (x, y) in samples])
+    ys = np.array([y for (x, y) in samples], np.float_)
+    return np.column_stack((xs, ys))
 
 def common_period(start, end):
     categories = ['year', 'month', 'day', 'hour', 'minute', 'second']
@@ -1,15 +1,93 @@
+import bisect
 import collections
 import datetime
+import heapq
 import operator
-import bisect
-import json
+
+import numpy as np
+
+from chunkcache import shared_cache
+from database import (EPOCH, ROLLUP_LEVELS, SignalTable, database_path,
+                      decode_datum, rollup_table, to_epoch_us, from_epoch_us)
 
 getx = operator.itemgetter(0)
 gety = operator.itemgetter(1)
 
+NaN = float("nan")
+Inf = float("inf")
+
+def to_epoch(t):
+    "Converts a naive UTC datetime to float seconds since the epoch"
+    if isinstance(t, datetime.datetime):
+        return (t - EPOCH).total_seconds()
+    return t
+
+def from_epoch(seconds):
+    return EPOCH + datetime.timedelta(seconds=float(seconds))
+
+def is_number(value):
+    "Whether a datum is a finite number, and so counts towards the statistics"
+    return (isinstance(value, (int, long, float)) and not isinstance(value, bool)
+            and -Inf < value < Inf)
+
+def to_value(value):
+    "Converts a datum to a float, or NaN if it isn't numeric"
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NaN
+
 class GraphData:
-    def __init__(self, initial=None):
-        self.data = []
+    """
+    GraphData stores the most recent samples of one live signal in a pair of
+    NumPy arrays: float64 seconds since the Unix epoch and float64 values.
+    Non-numeric values are stored as NaN.
+
+    The arrays are a linear buffer twice the capacity. Samples are appended
+    at the end, and once capacity samples are held the oldest one is dropped
+    by advancing the start index. When the end of the buffer is reached the
+    live region is copied back to the front, so appending is amortized O(1)
+    and memory never grows past 2 * capacity samples. The buffer starts
+    small and grows up to that limit, so quiet signals stay cheap.
+
+    addPoints takes a whole batch at once. A batch that is in order and
+    starts after the newest sample held is copied onto the end in one step;
+    anything else takes the reorder path, which sorts the batch and merges
+    it into the samples held.
+
+    Samples from the car routinely arrive a little out of order, so with a
+    reorder_window of w seconds, samples are first held in a small heap
+    until they are w seconds older than the newest sample seen (or until
+    release is called with a time w seconds after them) and only then
+    appended to the buffer, in order. A sample that turns up after newer
+    samples have already been appended is late: it is counted in late and
+    merged into the buffer the slow way.
+
+    instance variables:
+        capacity - the maximum number of samples kept
+        peak     - the largest value seen so far
+        min      - the smallest value seen so far
+        reorder_window - how long, in seconds, samples are held back to be
+                         put in order
+        late     - the number of samples that arrived too late to be put
+                   in order by the reorder window
+
+    method summary:
+        addPoint(point)    - adds a (datetime, value) sample, in order or not
+        addPoints(points)  - adds a batch of samples, in order or not
+        release(now)       - appends held samples older than the reorder
+                             window, or all of them if now is None
+        window(start, end) - returns zero-copy views of the times and values
+                             between start and end
+        filter             - drops samples outside of [earliest, latest]
+        export             - returns the samples as (datetime, value) tuples
+    """
+    initial_size = 1024
+    def __init__(self, initial=None, capacity=65536, reorder_window=0.0):
+        self.capacity = capacity
+        self.reorder_window = reorder_window
+        self.clear()
+        self.late = 0
         self.total = 0
         self.peak = -2e308
         self.min = 2e308
@@ -17,39 +95,178 @@ class GraphData:
         if initial:
             self.addPoints(initial)
 
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def times(self):
+        "The sample times in seconds since the epoch, oldest first"
+        return self._times[self.start:self.end]
+
+    @property
+    def values(self):
+        return self._values[self.start:self.end]
+
     @property
     def x(self):
-        return map(getx, self.data)
+        return map(from_epoch, self.times)
 
     @property
     def y(self):
-        return map(gety, self.data)
+        return list(self.values)
 
     @property
     def y_bounds(self):
-        if not self.data:
+        if self.start == self.end:
             return 0.0, 1.0
         diff = abs(self.peak - self.min)
         return self.min - diff * 0.10, self.peak + diff * 0.10
-    
-    def addPoint(self, point):
-        if not self.data or point[0] >= self.data[-1][0]:
-            self.data.append(point)
+
+    def _make_room(self, n=1):
+        "Ensures there is space for n more samples (n <= capacity) at the end"
+        size = len(self._times)
+        if self.end + n <= size:
+            return
+        count = self.end - self.start
+        if size < 2 * self.capacity:
+            while size < count + n:
+                size *= 2
+            size = min(size, 2 * self.capacity)
+            times = np.empty(size, np.float64)
+            values = np.empty(size, np.float64)
+            times[:count] = self._times[self.start:self.end]
+            values[:count] = self._values[self.start:self.end]
+            self._times, self._values = times, values
         else:
-            bisect.insort(self.data, point)
-        try:
-            self.total += point[1]
-            self.aveCounter += 1
-            if point[1] > self.peak:
-                self.peak = point[1]
-            if point[1] < self.min:
-                self.min = point[1]
-        except TypeError:
-            pass
+            self._times[:count] = self._times[self.start:self.end]
+            self._values[:count] = self._values[self.start:self.end]
+        self.start, self.end = 0, count
+
+    def addPoint(self, point):
+        return self.addPoints([point])
 
     def addPoints(self, points):
-        for point in points:
-            self.addPoint(point)
+        """
+        Adds a batch of (time, value) samples. Returns the number of samples
+        added to the buffer, which leaves out any held in the reorder window.
+        """
+        if not points:
+            return 0
+        times = np.array([to_epoch(t) for (t, value) in points], np.float64)
+        values = np.array([to_value(value) for (t, value) in points], np.float64)
+
+        numeric = values[values == values]
+        if len(numeric):
+            self.total += numeric.sum()
+            self.aveCounter += len(numeric)
+            self.peak = max(self.peak, numeric.max())
+            self.min = min(self.min, numeric.min())
+
+        if len(times) > 1 and (np.diff(times) < 0).any():
+            order = np.argsort(times, kind="mergesort")
+            times, values = times[order], values[order]
+
+        added = 0
+        if self.start != self.end and times[0] < self._times[self.end-1]:
+            late = np.searchsorted(times, self._times[self.end-1], "left")
+            if not self.reorder_window:
+                self._merge(times, values)
+                self.late += late
+                return len(times)
+            self._merge(times[:late], values[:late])
+            self.late += late
+            added += late
+            times, values = times[late:], values[late:]
+            if not len(times):
+                return added
+
+        if not self.reorder_window:
+            self._append(times, values)
+            return added + len(times)
+
+        in_order = times[0] >= self.newest
+        self.newest = max(self.newest, times[-1])
+        cutoff = self.newest - self.reorder_window
+        if not self.pending:
+            ready = np.searchsorted(times, cutoff, "right")
+            self._append(times[:ready], values[:ready])
+            self.pending = zip(times[ready:].tolist(), values[ready:].tolist())
+            self.pending_sorted = True
+            return added + ready
+        elif in_order and self.pending_sorted:
+            self.pending.extend(zip(times.tolist(), values.tolist()))
+        else:
+            #A sorted list is already a heap
+            self.pending_sorted = False
+            for sample in zip(times.tolist(), values.tolist()):
+                heapq.heappush(self.pending, sample)
+        return added + self._release(cutoff)
+
+    def release(self, now=None):
+        """
+        Appends the held samples from more than reorder_window seconds
+        before now, or all of them if now is None. Returns how many there
+        were.
+        """
+        if now is None:
+            return self._release(Inf)
+        return self._release(to_epoch(now) - self.reorder_window)
+
+    def _release(self, cutoff):
+        pending = self.pending
+        if self.pending_sorted:
+            #Nothing has arrived out of order, so it's still a plain list
+            i = bisect.bisect_right(pending, (cutoff, Inf))
+            ready = pending[:i]
+            del pending[:i]
+        else:
+            ready = []
+            while pending and pending[0][0] <= cutoff:
+                ready.append(heapq.heappop(pending))
+            if not pending:
+                self.pending_sorted = True
+        if ready:
+            self._append(np.array([t for (t, value) in ready], np.float64),
+                         np.array([value for (t, value) in ready], np.float64))
+        return len(ready)
+
+    def _append(self, times, values):
+        "Copies sorted samples that are all newer than the last onto the end"
+        n = len(times)
+        if not n:
+            return
+        elif n >= self.capacity:
+            self._replace(times, values)
+            return
+        self._make_room(n)
+        end = self.end
+        self._times[end:end+n] = times
+        self._values[end:end+n] = values
+        self.end = end + n
+        if self.end - self.start > self.capacity:
+            self.start = self.end - self.capacity
+
+    def _merge(self, times, values):
+        "The reorder path: merges sorted samples in among the samples held"
+        held = self.times
+        positions = np.searchsorted(held, times, "right")
+        self._replace(np.insert(held, positions, times),
+                      np.insert(self.values, positions, values))
+
+    def _replace(self, times, values):
+        "Replaces the samples held with the newest capacity of times and values"
+        times, values = times[-self.capacity:], values[-self.capacity:]
+        count = len(times)
+        size = len(self._times)
+        if size < count:
+            while size < count:
+                size *= 2
+            size = min(size, 2 * self.capacity)
+            self._times = np.empty(size, np.float64)
+            self._values = np.empty(size, np.float64)
+        self._times[:count] = times
+        self._values[:count] = values
+        self.start, self.end = 0, count
 
     @property
     def average(self):
@@ -57,37 +274,81 @@ class GraphData:
             return float(self.total) / self.aveCounter
         return 0.0
 
+    def window(self, start=None, end=None):
+        """
+        Returns (times, values) views of the samples from start to end,
+        inclusive. start and end may be datetimes or epoch seconds.
+        """
+        times = self.times
+        i, j = 0, len(times)
+        if start is not None:
+            i = np.searchsorted(times, to_epoch(start), "left")
+        if end is not None:
+            j = np.searchsorted(times, to_epoch(end), "right")
+        return times[i:j], self._values[self.start+i:self.start+j]
+
     def export(self):
-        return self.data
+        return zip(self.x, self.y)
 
     def filter(self, earliest=None, latest=None):
-        if earliest is None:
-            earliest = datetime.datetime.min
-        if latest is None:
-            latest = datetime.datetime.max
-
-        if self.data and self.data[0][0] > earliest:
-            del self.data[:bisect.bisect_left(self.data, (earliest, 0.0))]
-        if self.data and self.data[-1][0] > latest:
-            del self.data[bisect.bisect_right(self.data, (latest, 2e308)):]
+        times = self.times
+        if earliest is not None:
+            self.start += np.searchsorted(times, to_epoch(earliest), "left")
+        if latest is not None:
+            self.end = self.start + np.searchsorted(self.times, to_epoch(latest), "right")
 
     def clear(self):
-        self.data = []
+        size = min(self.initial_size, 2 * self.capacity)
+        self._times = np.empty(size, np.float64)
+        self._values = np.empty(size, np.float64)
+        self.start = self.end = 0
+        self.pending = []
+        self.pending_sorted = True
+        self.newest = -Inf
 
 class XOMBIESQLIntervalView:
-    query_template = ("SELECT time, data FROM data"
-                      " WHERE id = ? AND name = ? AND"
-                      " ? <= time AND time <= ? ORDER BY time;")
-    def __init__(self, connection, id_, name, start=datetime.datetime.min, end=datetime.datetime.max):
+    """
+    A view of one signal's data between start and end, loaded from the data
+    table. If the number of pixels the view is drawn across is known, and
+    the range is wide enough that a rollup level still has at least one
+    bucket per pixel, the coarsest such level is loaded instead of the raw
+    rows. Each bucket then contributes its minimum and maximum, both at the
+    middle of the bucket, so the plot still shows the envelope of the data.
+
+    Raw rows are kept in a deque. When a new range overlaps the one already
+    loaded, only the newly exposed slices are queried and rows that fell
+    out of range are dropped from the ends. The count, total, peak and min
+    are updated as rows come and go. The data is only rescanned if a
+    dropped row was the current peak or min.
+
+    Rows are read through the shared ChunkCache, so views of the same
+    signal in different tabs share what has already been loaded.
+    """
+    cache = shared_cache
+    query_template = ("SELECT epoch, value, data FROM data"
+                      " WHERE signal_id = ? AND"
+                      " ? <= epoch AND epoch <= ? ORDER BY epoch;")
+    rollup_query_template = ("SELECT bucket, count, min, max, sum FROM %s"
+                             " WHERE signal_id = ? AND"
+                             " ? <= bucket AND bucket <= ? ORDER BY bucket;")
+    def __init__(self, connection, id_, name, start=datetime.datetime.min, end=datetime.datetime.max,
+                 signals=None, pixels=None):
         self.connection = connection
-        self.id = str(int(id_, 16))
+        self.id = int(id_, 16)
         self.name = name
         self.query = self.query_template
+        if signals is None:
+            signals = SignalTable(connection)
+        self.signal_id = signals.find(self.id, self.name)
+        self.pixels = pixels
+        self.path = database_path(connection)
 
         self.peak = -2e308
         self.min = 2e308
+        self.count = 0
+        self.total = 0.0
 
-        self.start = self.end = self.data = None
+        self.start = self.end = self.data = self.level = None
         self.load(start, end)
 
     @property
@@ -110,33 +371,166 @@ class XOMBIESQLIntervalView:
         return bool(self.data)
 
     def fetch(self, start, end):
-        data = self.connection.execute(self.query, (self.id, self.name, start, end))
-        for time, data_str in data:
-            yield time, json.loads(data_str)
-        return 
-
-    def load(self, start, end):
+        return self.fetch_epochs(to_epoch_us(start), to_epoch_us(end))
+
+    def fetch_epochs(self, start, end):
+        "Like fetch, but with inclusive bounds in epoch microseconds"
+        if self.signal_id is None:
+            return []
+        elif self.cache is None:
+            return [point for (epoch, point) in self.query_rows(start, end)]
+        return self.cache.fetch((self.path, "data", self.signal_id),
+                                start, end, self.query_rows)
+
+    def query_rows(self, start, end):
+        data = self.connection.execute(self.query, (self.signal_id, start, end))
+        return [(epoch, (from_epoch_us(epoch), decode_datum(value, data_str)))
+                for epoch, value, data_str in data]
+
+    def pick_level(self, start, end):
+        """
+        Returns the coarsest rollup level with at least one bucket per pixel
+        between start and end, or None if the raw data should be used
+        """
+        if not self.pixels:
+            return None
+        span = (end - start).total_seconds()
+        for level in reversed(ROLLUP_LEVELS):
+            if span / level >= self.pixels:
+                return level
+        return None
+
+    def fetch_rollup(self, level, start, end):
+        "Returns the (bucket, count, min, max, sum) rows of level between start and end"
+        if self.signal_id is None:
+            return []
+        table = rollup_table(level)
+        width = level * 1000000
+        def query_buckets(lo, hi):
+            rows = self.connection.execute(self.rollup_query_template % table,
+                                           (self.signal_id, lo // width, hi // width))
+            return [(row[0] * width, row) for row in rows]
+
+        start = to_epoch_us(start) // width * width
+        end = to_epoch_us(end)
+        if self.cache is None:
+            return [row for (epoch, row) in query_buckets(start, end)]
+        #Cache chunks are a whole number of buckets wide for every level
+        return self.cache.fetch((self.path, table, self.signal_id),
+                                start, end, query_buckets)
+
+    def load_rollup(self, level, start, end):
+        self.data = []
+        rows = self.fetch_rollup(level, start, end)
+        width = level * 1000000
+        half = datetime.timedelta(seconds=level / 2.0)
+        self.count = 0
+        self.total = 0.0
+        self.peak = -2e308
+        self.min = 2e308
+        for bucket, n, low, high, bucket_total in rows:
+            t = from_epoch_us(bucket * width) + half
+            self.data.append((t, low))
+            self.data.append((t, high))
+            self.count += n
+            self.total += bucket_total
+            if high > self.peak:
+                self.peak = high
+            if low < self.min:
+                self.min = low
+
+    def load(self, start, end, pixels=None):
         if start > end:
             start, end = end, start
-        if start == self.start and end == self.end:
+        if pixels is not None:
+            self.pixels = pixels
+        level = self.pick_level(start, end)
+        if start == self.start and end == self.end and level == self.level:
             return
+        elif level is not None:
+            self.load_rollup(level, start, end)
+        elif (self.level is None and self.data is not None and
+              start <= self.end and end >= self.start):
+            self.load_edges(start, end)
         else:
-            self.start = start
-            self.end = end
-            self.data = list(self.fetch(start, end))
+            self.data = collections.deque(self.fetch(start, end))
+            self.rescan()
+        self.start = start
+        self.end = end
+        self.level = level
+
+    def prefetch(self, start, end):
+        """
+        Reads the rows load(start, end) would need into the cache without
+        changing what the view holds. Does nothing if there is no cache.
+        """
+        if self.cache is None:
+            return
+        if start > end:
+            start, end = end, start
+        level = self.pick_level(start, end)
+        if level is None:
+            self.fetch(start, end)
+        else:
+            self.fetch_rollup(level, start, end)
+
+    def load_edges(self, start, end):
+        "Moves the loaded raw range to overlapping range start, end"
+        data = self.data
+        self.stale = False
+        if start > self.start:
+            while data and data[0][0] < start:
+                self.remove_point(data.popleft())
+        elif start < self.start:
+            added = list(self.fetch_epochs(to_epoch_us(start), to_epoch_us(self.start) - 1))
+            data.extendleft(reversed(added))
+            for point in added:
+                self.add_point(point)
+
+        if end < self.end:
+            while data and data[-1][0] > end:
+                self.remove_point(data.pop())
+        elif end > self.end:
+            added = list(self.fetch_epochs(to_epoch_us(self.end) + 1, to_epoch_us(end)))
+            data.extend(added)
+            for point in added:
+                self.add_point(point)
+
+        if self.stale:
+            self.rescan()
+
+    def add_point(self, point):
+        value = point[1]
+        if not is_number(value):
+            return
+        self.count += 1
+        self.total += value
+        if value > self.peak:
+            self.peak = value
+        if value < self.min:
+            self.min = value
+
+    def remove_point(self, point):
+        value = point[1]
+        if not is_number(value):
+            return
+        self.count -= 1
+        self.total -= value
+        if value >= self.peak or value <= self.min:
+            self.stale = True
+
+    def rescan(self):
+        "Recomputes the running statistics from all of the loaded data"
+        self.count = 0
+        self.total = 0.0
+        self.peak = -2e308
+        self.min = 2e308
+        for point in self.data:
+            self.add_point(point)
 
-            count = 0
-            total = 0.0
-            self.peak = -2e308
-            self.min = 2e308
-            for t, value in self.data:
-                count += 1
-                total += value
-                if value > self.peak:
-                    self.peak = value
-                if value < self.min:
-                    self.min = value
-            self.average = total/count if count != 0 else 0.0
+    @property
+    def average(self):
+        return self.total/self.count if self.count != 0 else 0.0
 
     def filter(self, earliest=None, latest=None):
         pass
@@ -145,8 +539,10 @@ class XOMBIESQLIntervalView:
         self.data = None
         self.peak = -2e308
         self.min = 2e308
+        self.count = 0
+        self.total = 0.0
 
-        self.start = self.end = None
+        self.start = self.end = self.level = None
         
 
     @property
@@ -162,10 +558,12 @@ class XOMBIESQLIntervalView:
 
 class MinimalSQLIntervalView:
     query_template = "SELECT time, value FROM %s WHERE ? <= time AND time <= ? ORDER BY time;"
+    cache = shared_cache
     def __init__(self, connection, table, start=datetime.datetime.min, end=datetime.datetime.max):
         self.connection = connection
         self.table = table
         self.query = self.query_template % self.table
+        self.path = database_path(connection)
 
         self.start = self.end = self.data = None
         self.load(start, end)
@@ -183,7 +581,15 @@ class MinimalSQLIntervalView:
         return bool(self.data)
 
     def fetch(self, start, end):
-        return self.connection.execute(self.query, (start, end))
+        if self.cache is None:
+            return self.connection.execute(self.query, (start, end))
+        return self.cache.fetch((self.path, self.table), to_epoch_us(start),
+                                to_epoch_us(end), self.query_rows)
+
+    def query_rows(self, start, end):
+        rows = self.connection.execute(self.query, (from_epoch_us(start),
+                                                    from_epoch_us(end)))
+        return [(to_epoch_us(row[0]), row) for row in rows]
 
     def load(self, start, end):
         if start > end:
@@ -1,4 +1,6 @@
 import datetime
+import os
+import sqlite3 as sql
 import matplotlib.dates as mdates
 from matplotlib.axes import Subplot
 from matplotlib.figure import Figure
@@ -6,7 +8,10 @@ from PySide import QtGui, QtCore
 
 from backend_pysideagg import FigureCanvasQTAgg as FigureCanvas
 from DatePlot import DatetimeCollection, KenLocator, KenFormatter
+from decimate import axes_buckets
 from GraphData import XOMBIESQLIntervalView
+from chunkcache import shared_cache
+from database import SignalTable, database_path
 from SignalWidget import SignalTreeWidget, SignalListEditorDialog
 from ViewWidget import BaseTabViewWidget
 
@@ -39,7 +44,8 @@ class HistoricalGraphTabView(BaseTabViewWidget):
                 for [name, units, desc] in descr.get("messages", []):
                     desc_map[id_+":"+name] = descr
         
-        self.plotWidget = HistoricalPlot(desc_map, connection, self)
+        self.signals = SignalTable(connection)
+        self.plotWidget = HistoricalPlot(desc_map, connection, self.signals, self)
         self.controlWidget = ControlWidget(self.plotWidget, parent=self)
         self.layout = QtGui.QVBoxLayout(self)
         self.layout.addWidget(self.plotWidget)
@@ -63,7 +69,7 @@ class HistoricalGraphTabView(BaseTabViewWidget):
             self.add_signal(descr)
 
     def redraw(self):
-        self.plotWidget.redraw()
+        return self.plotWidget.redraw()
 
     def cleanup(self):
         self.plotWidget.cleanup()
@@ -81,13 +87,113 @@ class HistoricalGraphTabView(BaseTabViewWidget):
         
         menu.popup(event.globalPos())
 
+class IntervalSnapshot(object):
+    """
+    A copy of what an XOMBIESQLIntervalView held after a load, safe to hand
+    to the GUI thread while the loader goes on to reuse the view.
+    """
+    def __init__(self, view=None):
+        if view is None:
+            self.data = []
+            self.peak = self.min = self.average = 0.0
+            self.start = self.end = self.level = None
+        else:
+            self.data = list(view.data)
+            self.peak = view.peak
+            self.min = view.min
+            self.average = view.average
+            self.start = view.start
+            self.end = view.end
+            self.level = view.level
+
+    @property
+    def y_bounds(self):
+        if not self.data:
+            return 0.0, 1.0
+        diff = abs(self.peak - self.min)
+        return self.min - diff * 0.10, self.peak + diff * 0.10
+
+    def export(self):
+        return self.data
+
+class HistoricalLoader(QtCore.QObject):
+    """
+    Loads the signals shown by a HistoricalPlot off of the GUI thread.
+
+    Requests arrive through the load slot as (generation, start, end,
+    pixels, signals) tuples, where signals is a list of (identifier, can id,
+    name) tuples. The loader keeps one XOMBIESQLIntervalView per signal on
+    its own database connection and emits loaded with the generation and a
+    dict of IntervalSnapshots once a request is done. It then reads the
+    windows of the same width to either side into the shared chunk cache,
+    so the next pan in either direction is served from memory.
+
+    latest is set by the GUI thread to the newest generation it has asked
+    for. Requests that have been overtaken are skipped, and prefetching
+    stops as soon as a newer request is waiting.
+    """
+    loaded = QtCore.Signal(int, object)
+
+    def __init__(self, connection, prefetch=True, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.path = database_path(connection)
+        if os.path.exists(self.path):
+            self.connection = sql.connect(self.path, check_same_thread=False,
+                                          detect_types=(sql.PARSE_DECLTYPES
+                                                        | sql.PARSE_COLNAMES))
+            self.owns_connection = True
+        else:
+            #In-memory databases can't be opened twice
+            self.connection = connection
+            self.owns_connection = False
+        self.signals = SignalTable(self.connection)
+        self.prefetch = prefetch
+        self.views = {}
+        self.latest = 0
+
+    def load(self, request):
+        generation, start, end, pixels, signals = request
+        if generation < self.latest:
+            return
+
+        results = {}
+        for ident, id_, name in signals:
+            view = self.views.get(ident)
+            if view is None:
+                view = XOMBIESQLIntervalView(self.connection, id_, name,
+                                             start, end, self.signals, pixels)
+                self.views[ident] = view
+            else:
+                view.load(start, end, pixels)
+            results[ident] = IntervalSnapshot(view)
+        for ident in set(self.views) - set(results):
+            del self.views[ident]
+        self.loaded.emit(generation, results)
+
+        if not self.prefetch:
+            return
+        span = end - start
+        for left, right in [(end, end + span), (start - span, start)]:
+            for ident in results:
+                if self.latest > generation:
+                    return
+                self.views[ident].prefetch(left, right)
+
+    def close(self):
+        self.views.clear()
+        if self.owns_connection:
+            self.connection.close()
+
 class HistoricalPlot(FigureCanvas):
-    def __init__(self, desc_map, connection, parent=None):
+    load_requested = QtCore.Signal(object)
+
+    def __init__(self, desc_map, connection, signals, parent=None):
         figure = Figure(figsize=(3,3), dpi=72)
         FigureCanvas.__init__(self, figure, parent)
 
         self.figure = figure
         self.connection = connection
+        self.signals = signals
         self.desc_map = desc_map
         
         self.start = datetime.datetime.utcnow()
@@ -100,16 +206,33 @@ class HistoricalPlot(FigureCanvas):
         self.views = {}
         self.autoscale = True
         self.showing_dialog = False
+        self.dirty = True
 
         FigureCanvas.setSizePolicy(self, QtGui.QSizePolicy.Expanding,
                                          QtGui.QSizePolicy.Expanding)
         FigureCanvas.updateGeometry(self)
         
         self.plot = self.figure.add_subplot(111)
+        self.plot.set_xbound(self.start, self.end)
+        locator = KenLocator(5)
+        self.plot.xaxis.set_major_locator(locator)
+        self.plot.xaxis.set_major_formatter(KenFormatter(locator))
         self.setAcceptDrops(True)
 
         link(self.adjust_signals_action.triggered, self.adjust_signals)
 
+        #Connected directly rather than with link, so that Qt queues the
+        #calls across to the loader's thread and back again.
+        self.generation = 0
+        self.loader = HistoricalLoader(connection)
+        self.loader_thread = None
+        if self.loader.owns_connection:
+            self.loader_thread = QtCore.QThread(self)
+            self.loader.moveToThread(self.loader_thread)
+            self.loader_thread.start()
+        self.load_requested.connect(self.loader.load)
+        self.loader.loaded.connect(self.show_loaded)
+
     def adjust_signals(self):
 ##        if self.showing_dialog:
 ##            return
@@ -146,18 +269,36 @@ class HistoricalPlot(FigureCanvas):
         self.plot.set_xbound(self.start,
                              self.end)
 
-        locator = KenLocator(5)
-        self.plot.xaxis.set_major_locator(locator)
-        formatter = KenFormatter(locator)
-        self.plot.xaxis.set_major_formatter(formatter)
-        
         for ident, (view, collection) in self.views.items():
-            view.load(self.start, self.end)
+            self.update_segments(collection, view)
+        self.dirty = True
+        self.request_load()
+
+    def request_load(self):
+        "Asks the loader for the data of every signal between start and end"
+        self.generation += 1
+        self.loader.latest = self.generation
+        signals = []
+        for ident in self.views:
+            id_, name = ident.split(":", 1)
+            signals.append((ident, id_, name))
+        self.load_requested.emit((self.generation, self.start, self.end,
+                                  axes_buckets(self.plot), signals))
+
+    def show_loaded(self, generation, results):
+        "Plots the snapshots sent back by the loader, unless they're out of date"
+        if generation != self.generation:
+            return
+        for ident, view in results.items():
+            if ident not in self.views:
+                continue
+            old_view, collection = self.views[ident]
+            self.views[ident] = (view, collection)
             ymin, ymax = view.y_bounds
-            collection.set_segments([view.export()])
+            self.update_segments(collection, view)
             if self.autoscale:
-                cmin, cmax = self.plot.get_ybound()
                 self.plot.yaxis.set_view_interval(ymin, ymax, ignore=False)
+            self.dirty = True
 
     def add_json(self, json):
         json["xview"] = tuple(self.plot.get_xbound())
@@ -186,21 +327,32 @@ class HistoricalPlot(FigureCanvas):
         if desc.get("non_numeric") in frozenset(["true", "True", True]):
             return
         
-        signal_id, signal_name = ident.split(":", 1)
         collection = DatetimeCollection([])
         self.plot.add_collection(collection)
-        view = XOMBIESQLIntervalView(self.connection, signal_id,
-                                     signal_name, self.start, self.end)
-        self.views[ident] = (view, collection)
-        collection.set_segments(view.export())
+        self.views[ident] = (IntervalSnapshot(), collection)
+        self.request_load()
+
+    def update_segments(self, collection, view):
+        "Plots the samples in view, decimated to the width of the plot"
+        left, right = self.plot.get_xbound()
+        collection.set_decimation(left, right, axes_buckets(self.plot))
+        collection.set_segments([view.export()])
 
     def redraw(self):
+        "Redraws the plot if anything has changed. Returns whether it did"
+        if not self.dirty:
+            return False
+        self.dirty = False
         self.draw()
-        self.figure.canvas.draw()
+        return True
 
     def cleanup(self):
         for ident, (view, collection) in self.views.items():
             collection.remove()
+        if self.loader_thread is not None:
+            self.loader_thread.quit()
+            self.loader_thread.wait()
+        self.loader.close()
     
 
 class ControlWidget(QtGui.QWidget):
@@ -211,16 +363,23 @@ class ControlWidget(QtGui.QWidget):
 
         self.left_dt_control = CustomDateTimeEdit(date=start_date, parent=self)
         self.right_dt_control = CustomDateTimeEdit(date=end_date, parent=self)
+        self.cache_label = QtGui.QLabel(self)
         self.layout.addWidget(self.left_dt_control)
         self.layout.addWidget(self.right_dt_control)
+        self.layout.addWidget(self.cache_label)
         self.setLayout(self.layout)
 
         def update_left(dt):
             self.plot.update_bounds(dt, None)
+            self.update_cache_label()
 
         def update_right(dt):
             self.plot.update_bounds(None, dt)
+            self.update_cache_label()
 
         link(self.left_dt_control.pyDateTimeChanged, update_left)
         link(self.right_dt_control.pyDateTimeChanged, update_right)
 
+    def update_cache_label(self):
+        self.cache_label.setText("Cache: %.0f%% hits" % (100 * shared_cache.hit_rate))
+        self.cache_label.setToolTip(shared_cache.summary())
@@ -3,11 +3,15 @@ import json
 import matplotlib.dates as mdates
 from matplotlib.axes import Subplot
 from matplotlib.figure import Figure
+from matplotlib.transforms import Bbox
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
 
 from PySide import QtGui, QtCore
 
 from backend_pysideagg import FigureCanvasQTAgg as FigureCanvas
-from DatePlot import DatetimeCollection, KenLocator, KenFormatter
+from decimate import axes_buckets
+from DatePlot import DatetimeCollection, KenLocator, KenFormatter, epoch_to_ordinal, ordinal_to_epoch
 from SignalWidget import SignalTreeWidget, SignalListEditorDialog
 from ViewWidget import BaseTabViewWidget
 from util import link
@@ -32,6 +36,14 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
         plots       - the subplot objects being displayed
         tab_bar     - the TabWidget to which this tab belongs
         timescale   - the duration in seconds of previous data displayed
+        incremental - whether to use strip-chart updates: the x-axis is only
+                      moved when the present runs off the right edge, and
+                      in between frames only the signal lines are redrawn
+                      and blitted over a cached background of each plot
+        lookahead   - how far past the present the x-axis extends in
+                      incremental mode, as a fraction of the timescale
+        dirty       - whether anything shown has changed since the last
+                      redraw. Idle tabs are not redrawn at all.
 
     method summary:
         json_friendly - returns a simple representation of the tab view suitable
@@ -50,7 +62,10 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
         remove_plot(plot)- removes the subplot from this view and rescales the
                            remaining subplots.
 
-        redraw           - redraws all plots and the figure.
+        redraw           - redraws all plots and the figure, or in incremental
+                           mode, only the signal lines when no plot limits
+                           have changed. Does nothing and returns False if
+                           the view isn't dirty.
     """
     view_name = "Live Graph View"
     view_id   = "live.graph"
@@ -67,6 +82,11 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
         self.tab_bar = tab_bar
         self.timescale = 30
         self.find_source = source_finder
+        self.incremental = True
+        self.lookahead = 0.2
+        self.backgrounds = None
+        self.background_size = None
+        self.dirty = True
 
         #General plan for actions:
         #Plot specific actions are dispatched through the contextMenuEvent
@@ -77,8 +97,13 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
         #respectively.
         self.timescale_action = QtGui.QAction("Adjust timescale", self)
         self.addAction(self.timescale_action)
+        self.incremental_action = QtGui.QAction("Incremental updates", self)
+        self.incremental_action.setCheckable(True)
+        self.incremental_action.setChecked(self.incremental)
+        self.addAction(self.incremental_action)
 
         link(self.timescale_action.triggered, self.adjust_timescale)
+        link(self.incremental_action.toggled, self.set_incremental)
         FigureCanvas.setSizePolicy(self, QtGui.QSizePolicy.Expanding,
                                          QtGui.QSizePolicy.Expanding)
         FigureCanvas.updateGeometry(self)
@@ -124,6 +149,7 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
 
         self.figure.add_subplot(new_plot)
         self.plots.append(new_plot)
+        self.dirty = True
 
         return new_plot
     
@@ -137,6 +163,7 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
         rows = len(self.plots)
         for i, axes in enumerate(self.plots):
             axes.change_geometry(rows, 1, i+1)
+        self.dirty = True
 
     #TabView maintenance methods
     def cleanup(self):
@@ -149,6 +176,7 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
         "Serializes to a json-friendly data-structure. Adds timescale and plot info"
         json = BaseTabViewWidget.json_friendly(self)
         json["timescale"] = self.timescale
+        json["incremental"] = self.incremental
         json["plots"] = [plot.json_friendly() for plot in self.plots]
         return json
 
@@ -156,6 +184,7 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
     def from_json(cls, json, tab_bar, find_source, parent=None):
         tab = cls(tab_bar, find_source, parent)
         tab.timescale = json["timescale"]
+        tab.incremental_action.setChecked(json.get("incremental", True))
         
         for plot_desc in json["plots"]:
             plot = tab.add_plot([])
@@ -167,12 +196,48 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
         "Copy any pending data to the plots and update the data limits"
         td = datetime.timedelta(seconds=self.timescale)
         for plot in self.plots:
-            plot.update_data(now, td)
+            if plot.update_data(now, td):
+                self.dirty = True
 
     def redraw(self):
-        "Redraw with updated axes ticks"
-        self.draw()
-        self.figure.canvas.draw()
+        "Redraw with updated axes ticks. Returns whether anything was drawn"
+        size = tuple(self.figure.bbox.size)
+        if not (self.dirty or size != self.background_size or
+                any(plot.needs_full_draw for plot in self.plots)):
+            return False
+        self.dirty = False
+
+        if not self.incremental or not self.plots:
+            self.draw()
+            self.background_size = size
+            for plot in self.plots:
+                plot.needs_full_draw = False
+            return True
+
+        if (self.backgrounds is None or size != self.background_size or
+            any(plot.needs_full_draw for plot in self.plots)):
+            #The signal lines are animated, so this draws everything else
+            FigureCanvasAgg.draw(self)
+            self.backgrounds = [(plot, self.copy_from_bbox(plot.bbox))
+                                for plot in self.plots]
+            self.background_size = size
+            for plot in self.plots:
+                plot.draw_signals()
+            self.replot = False
+            self.update()
+        else:
+            for plot, background in self.backgrounds:
+                self.restore_region(background)
+                plot.draw_signals()
+            self.blit(Bbox.union([plot.bbox for plot in self.plots]))
+        return True
+
+    def set_incremental(self, incremental):
+        self.incremental = incremental
+        self.backgrounds = None
+        self.dirty = True
+        for plot in self.plots:
+            plot.set_animated(incremental)
 
     #Context menu handlers
     def adjust_timescale(self):
@@ -181,6 +246,7 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
                                   "Seconds", self.timescale, 0.0)
         if accepted:
             self.timescale = new_scale
+            self.dirty = True
     
     def get_axes_at_point(self, x, y):
         trans = self.figure.transFigure.inverted()
@@ -211,7 +277,8 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
         axes = self.get_axes_at_point(event.x(), event.y())
         if axes is None:
             menu = QtGui.QMenu(self)
-            menu.addActions([self.tab_bar.rename_action, self.timescale_action])
+            menu.addActions([self.tab_bar.rename_action, self.timescale_action,
+                             self.incremental_action])
             menu.popup(event.globalPos())
             return
 
@@ -226,6 +293,7 @@ class LiveGraphTabView(BaseTabViewWidget, FigureCanvas):
 
         menu.addAction(self.tab_bar.rename_action)
         menu.addAction(self.timescale_action)
+        menu.addAction(self.incremental_action)
 
         link(delete_action.triggered, lambda: self.remove_plot(axes))
         
@@ -246,6 +314,12 @@ class LiveSubplot(Subplot):
                     use pre-determined limits
         static    - whether or not the plot should use static x-axis time
                     data limits instead of being pegged to the present.
+        paths     - a mapping from signal names to the time of the last
+                    sample plotted and the vertices plotted so far
+        versions  - a mapping from signal names to the DataSource version
+                    last plotted
+        needs_full_draw - whether the axes limits or signals have changed
+                          since the plot was last fully drawn
     method summary:
         json_friendly       - returns a json-friendly data structure containing:
                               * a list of signal names and color/line-styles
@@ -259,7 +333,9 @@ class LiveSubplot(Subplot):
         add_signal(name)    - adds the signal to the plot, if it doesn't already exist
         remove_signal(name) - removes the signal from the plot
         toggle_pause        - toggles paused status on/off
-        update_data         - updates plot data and data limits for any unpaused plots
+        update_data         - updates plot data and data limits for any unpaused plots,
+                              returning whether anything shown has changed
+        draw_signals        - draws just the signal lines, for blitting
     """
     def __init__(self, find_source, parent, *args, **kwargs):
         Subplot.__init__(self, parent.figure, *args, **kwargs)
@@ -268,6 +344,13 @@ class LiveSubplot(Subplot):
         self.paused = False
         self.autoscale = True
         self.static = False
+        self.paths = {}
+        self.versions = {}
+        self.needs_full_draw = True
+
+        locator = KenLocator(5)
+        self.xaxis.set_major_locator(locator)
+        self.xaxis.set_major_formatter(KenFormatter(locator))
 
         self.find_source = find_source
         
@@ -316,32 +399,104 @@ class LiveSubplot(Subplot):
             return
 
         collection = DatetimeCollection([])
+        collection.set_animated(self.parent.incremental)
         self.add_collection(collection)
         self.signals[name] = (self.find_source(name), collection)
+        self.needs_full_draw = True
 
     def remove_signal(self, name):
-        self.signals[name].remove()
+        self.signals[name][1].remove()
         del self.signals[name]
+        self.paths.pop(name, None)
+        self.versions.pop(name, None)
+        self.needs_full_draw = True
+
+    def set_animated(self, animated):
+        for name, (signal, collection) in self.signals.items():
+            collection.set_animated(animated)
+        self.needs_full_draw = True
+
+    def draw_signals(self):
+        for name, (signal, collection) in self.signals.items():
+            self.draw_artist(collection)
+        self.needs_full_draw = False
 
     def toggle_pause(self):
         self.paused = not self.paused
 
     def update_data(self, now, delta):
         if self.paused:
-            return
-
-        locator = KenLocator(5)
-        self.xaxis.set_major_locator(locator)
-        formatter = KenFormatter(locator)
-        self.xaxis.set_major_formatter(formatter)
+            return False
 
+        bounds = self.get_xbound(), self.get_ybound()
+        incremental = self.parent.incremental
+        if incremental:
+            self.scroll_xbound(now, delta)
+        else:
+            self.set_xbound(now-delta, now)
+        #Rebuild the lines from scratch whenever the x-axis moves, which
+        #also picks up any samples that arrived out of order
+        moved = self.get_xbound() != bounds[0]
+        rebuild = not incremental or moved
+        left, right = self.get_xbound()
+        start = float(ordinal_to_epoch(left))
+        buckets = axes_buckets(self)
+
+        changed = moved
         for name, (signal, collection) in self.signals.items():
+            #Signals that haven't received anything are left alone
+            if not rebuild and self.versions.get(name) == signal.version:
+                continue
+            self.versions[name] = signal.version
+            changed = True
             ymin, ymax = signal.data.y_bounds
-            collection.set_segments([signal.data.export()])
+            collection.set_decimation(left, right, buckets)
+            self.update_path(name, signal, collection, start, rebuild)
             if self.autoscale:
                 cmin, cmax = self.get_ybound()
                 self.yaxis.set_view_interval(ymin, ymax, ignore=False)
-        self.set_xbound(now-delta, now)
+
+        if (self.get_xbound(), self.get_ybound()) != bounds:
+            self.needs_full_draw = True
+        return changed or self.needs_full_draw
+
+    def scroll_xbound(self, now, delta):
+        """
+        Moves the x-axis so that it spans delta before now to a lookahead
+        margin after it, but only if now has run past the right edge or
+        the span has changed.
+        """
+        now = mdates.date2num(now)
+        span = delta.days + delta.seconds / 86400.0 + delta.microseconds / 86400e6
+        margin = span * self.parent.lookahead
+        left, right = self.get_xbound()
+        if not (left < now <= right) or abs((right - left) - (span + margin)) > 1e-9:
+            self.set_xbound(now - span, now + margin)
+
+    def update_path(self, name, signal, collection, start, rebuild):
+        """
+        Updates the line for one signal. Unless rebuild is set, only the
+        samples received since the last update are converted and appended.
+        """
+        if rebuild or name not in self.paths:
+            last, vertices = start, None
+            times, values = signal.data.window(start)
+        else:
+            last, vertices = self.paths[name]
+            times, values = signal.data.window(last)
+            new = np.searchsorted(times, last, "right")
+            times, values = times[new:], values[new:]
+
+        if len(times):
+            added = np.column_stack((epoch_to_ordinal(times), values))
+            if vertices is not None:
+                added = np.concatenate((vertices, added))
+            vertices = added
+            last = times[-1]
+            collection.set_segments([vertices])
+        elif vertices is None:
+            collection.set_segments([])
+        self.paths[name] = (last, vertices)
 
     def adjust_title(self):
         title, accepted = QtGui.QInputDialog.getText(self.parent,
@@ -350,6 +505,7 @@ class LiveSubplot(Subplot):
                           text=self.get_title())
         if accepted:
             self.set_title(title)
+            self.needs_full_draw = True
 
     def adjust_axes(self):
         dialog = QtGui.QDialog(self.parent)
@@ -408,6 +564,7 @@ class LiveSubplot(Subplot):
         cancel = buttonbox.button(QtGui.QDialogButtonBox.Cancel)
 
         def apply_changes():
+            self.needs_full_draw = True
             self.yaxis.set_label_text(y_units.text())
             if autoscale.isChecked():
                 self.autoscale = True
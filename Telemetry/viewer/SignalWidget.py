@@ -1,3 +1,4 @@
+import bisect
 import datetime
 import json
 import re
@@ -23,14 +24,20 @@ class SignalTreeWidget(QtGui.QTreeWidget):
     class variables:
         mimeType - the mimeType used to identifier our data in drag-and-drop
                    operations. However, the actual data is stored as text/plain
+        stale_ages - the ages in seconds at which a signal's color steps
+                     from fresh towards stale. The colors follow curve.
 
     method summary:
         add_descriptors - takes in a list of (filename, descriptor_set) objects
                           and builds the tree accordingly
+        update_colors   - colors each signal, and the packets and categories
+                          containing it, by how long ago it was received.
+                          Only items whose color has changed are touched.
     
     """
     mimeType = "application/x-data-signal-list"
     curve = QtCore.QEasingCurve(QtCore.QEasingCurve.InQuart)
+    stale_ages = (0.05, 0.75, 1.25, 1.6, 1.85, 2.05)
 
     def __init__(self, *args, **kwargs):
         QtGui.QTreeWidget.__init__(self, *args, **kwargs)
@@ -45,9 +52,21 @@ class SignalTreeWidget(QtGui.QTreeWidget):
         self._data = None
         self._mimeData = None
         self.widgets = {}
+        #id(item) -> index into stale_brushes of the item's current color
+        self.buckets = {}
+        self.stale_brushes = self.make_stale_brushes()
 
         self.descr_map = {}
 
+    def make_stale_brushes(self):
+        "Returns a brush for each age bucket, freshest first"
+        brushes = [QtGui.QBrush(QtGui.QColor.fromHsl(225, 255, 127, 127))]
+        last = self.stale_ages[-1] - self.stale_ages[0]
+        for age in self.stale_ages:
+            L = 0.5 + 0.5*self.curve.valueForProgress(min((age - self.stale_ages[0])/last, 1.0))
+            brushes.append(QtGui.QBrush(QtGui.QColor.fromHslF(225/360.0, 1.0, L, 0.5)))
+        return brushes
+
     def add_descriptors(self, desc_sets):
         pattern = re.compile(r"Battery Information Module (\d+) (?:Cell (\d+)|(.+))")
         #Note: we want to flatten trees of the form:
@@ -148,25 +167,36 @@ class SignalTreeWidget(QtGui.QTreeWidget):
         return mimeData
 
     def update_colors(self, items):
+        """
+        Takes (identifier, last received time) pairs. Each signal's age is
+        put in a bucket by stale_ages, and a packet or category takes the
+        freshest bucket of the signals under it.
+        """
         now = datetime.datetime.utcnow()
-        updated = {}
+        ages = self.stale_ages
+        freshest = {}
         for name, t in items:
+            if name not in self.widgets:
+                continue
             msg, parents = self.widgets[name]
-            dt = (now - t)
-            x = dt.seconds + 1e-6 * dt.microseconds
-            if x <= 0.05:
-                color = QtGui.QColor.fromHsl(225, 255, 127, 127)
-            else:
-                L = 0.5 + 0.5*self.curve.valueForProgress(min((x-0.05)/2.0, 1.0))
-                color = QtGui.QColor.fromHslF(225/360.0, 1.0, L, 0.5)
-            
-            msg.setBackground(0, color)
-            msg.setBackground(1, color)
+            bucket = bisect.bisect_left(ages, (now - t).total_seconds())
+            self.set_bucket(msg, bucket)
             for parent in parents:
-                if id(parent) not in updated or updated[id(parent)] > x:
-                    parent.setBackground(0, color)
-                    parent.setBackground(1, color)
-                    updated[id(parent)] = x
+                key = id(parent)
+                if key not in freshest or freshest[key][1] > bucket:
+                    freshest[key] = (parent, bucket)
+
+        for parent, bucket in freshest.itervalues():
+            self.set_bucket(parent, bucket)
+
+    def set_bucket(self, item, bucket):
+        "Colors item for the age bucket, unless it's already that color"
+        key = id(item)
+        if self.buckets.get(key) != bucket:
+            self.buckets[key] = bucket
+            brush = self.stale_brushes[bucket]
+            item.setBackground(0, brush)
+            item.setBackground(1, brush)
 
     @staticmethod
     def getMimeDataSignals(mimedata):
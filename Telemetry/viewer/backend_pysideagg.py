@@ -126,8 +126,9 @@ class FigureCanvasQTAgg( FigureCanvasQT, FigureCanvasAgg ):
         """
 
         if DEBUG: print "FigureCanvasQtAgg.draw", self
-        self.replot = True
+        #The figure is rendered here, so paintEvent only has to copy it
         FigureCanvasAgg.draw(self)
+        self.replot = False
         self.update()
 
     def blit(self, bbox=None):
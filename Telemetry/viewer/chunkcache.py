@@ -0,0 +1,126 @@
+"""
+Process-wide LRU cache of historical signal data.
+
+Historical views load their rows through ChunkCache.fetch, which splits the
+requested range into fixed-width time chunks and only queries the database
+for chunks it doesn't already hold. Two tabs showing the same signal, or one
+tab panning back over ground it has already covered, are then served from
+memory. The cache is bounded by an estimate of the memory its rows use, and
+the least recently used chunks are evicted first.
+
+Chunks that end less than settle_seconds ago aren't cached, since the logger
+may still be adding rows to them.
+"""
+import bisect
+import datetime
+import threading
+from collections import OrderedDict
+
+from database import to_epoch_us
+
+__all__ = ["ChunkCache", "shared_cache"]
+
+class ChunkCache(object):
+    """
+    An LRU cache of sorted rows, keyed by (key, chunk index).
+
+    instance variables:
+        max_bytes      - the approximate memory limit for cached rows
+        chunk_us       - the width of a chunk in epoch microseconds
+        row_bytes      - the estimated memory used by one cached row
+        hits, misses   - counts of chunk lookups served from the cache and
+                         loaded from the database
+        evictions      - count of chunks dropped to stay under max_bytes
+        size           - the estimated memory currently in use
+    """
+    def __init__(self, max_bytes=64 * 2**20, chunk_seconds=600,
+                 row_bytes=160, settle_seconds=60, max_chunks=4096):
+        self.max_bytes = max_bytes
+        self.chunk_us = chunk_seconds * 1000000
+        self.row_bytes = row_bytes
+        self.settle_us = settle_seconds * 1000000
+        self.max_chunks = max_chunks
+
+        self.lock = threading.Lock()
+        self.chunks = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def summary(self):
+        return "%d hits, %d misses (%.0f%%), %.1f MB in %d chunks" % (
+            self.hits, self.misses, 100 * self.hit_rate,
+            self.size / float(2**20), len(self.chunks))
+
+    def get(self, key):
+        with self.lock:
+            chunk = self.chunks.pop(key, None)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self.chunks[key] = chunk
+            self.hits += 1
+            return chunk[:2]
+
+    def put(self, key, epochs, items):
+        size = (len(items) + 1) * self.row_bytes
+        with self.lock:
+            old = self.chunks.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.chunks[key] = (epochs, items, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self.chunks) > 1:
+                evicted_key, (e, i, evicted_size) = self.chunks.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+            self.size = 0
+
+    def fetch(self, key, start, end, loader, now=None):
+        """
+        Returns the items stored under key with epochs between start and end
+        inclusive, in order. loader(lo, hi) must return a sorted list of
+        (epoch, item) pairs with lo <= epoch <= hi, and is only called for
+        chunks that aren't cached. Ranges spanning more than max_chunks
+        chunks go straight to the loader.
+        """
+        first = start // self.chunk_us
+        last = end // self.chunk_us
+        if last - first >= self.max_chunks:
+            return [item for (epoch, item) in loader(start, end)]
+
+        if now is None:
+            now = to_epoch_us(datetime.datetime.utcnow())
+        settled = now - self.settle_us
+
+        result = []
+        for index in xrange(first, last + 1):
+            lo = index * self.chunk_us
+            hi = lo + self.chunk_us - 1
+            chunk = self.get((key, index))
+            if chunk is None:
+                rows = loader(lo, hi)
+                chunk = [epoch for (epoch, item) in rows], [item for (epoch, item) in rows]
+                if hi < settled:
+                    self.put((key, index), *chunk)
+            epochs, items = chunk
+            i = bisect.bisect_left(epochs, start) if lo < start else 0
+            j = bisect.bisect_right(epochs, end) if hi > end else len(epochs)
+            result.extend(items[i:j])
+        return result
+
+#The cache used by every historical view in this process
+shared_cache = ChunkCache()
@@ -0,0 +1,689 @@
+"""
+Schema setup, migration and bulk writing for the telemetry SQLite database.
+
+Signals are listed once in the signals table, keyed by an integer signal_id
+and populated from the *.can.json descriptors. The data table refers to them
+by signal_id so the CAN id and name aren't repeated in every row.
+SignalTable keeps the mapping in memory for writers and views.
+
+The data table stores one row per decoded signal value. Numeric values go
+into the REAL value column; anything else (strings, booleans, integers too
+large to be represented exactly as a double, and NaN and infinite floats,
+since sqlite stores NaN as NULL) is stored as JSON text in the data column,
+with value left NULL.
+
+Every row also carries its time as an integer number of microseconds since
+the Unix epoch in the epoch column, which is what range queries use. The
+(signal_id, epoch) index lets a query for one signal over a time range seek
+straight to the rows it needs instead of scanning and sorting the table.
+
+For zoomed-out historical views, rollup_1, rollup_10, rollup_60 and
+rollup_600 hold the count, minimum, maximum, sum and last value of each
+signal's numeric samples in 1 s, 10 s, 1 min and 10 min buckets. Bucket
+numbers are epoch // width, and the rollups are kept up to date by
+BulkWriter as rows are inserted.
+
+While the viewer is running, DatabaseWriter owns all writes to the data
+table. It runs on its own thread with its own connection in WAL journal
+mode, so a slow commit never holds up serial reading and the viewer's
+connection can read while a commit is in progress.
+
+The schema version is tracked with PRAGMA user_version so that databases
+from older versions of the viewer can be upgraded in place by
+upgrade_database, either at startup or ahead of time with migrate_db.py.
+"""
+import collections
+import datetime
+import json
+import sqlite3 as sql
+import threading
+import time
+from Queue import Queue, Full, Empty
+
+__all__ = ["SCHEMA_VERSION", "table_exists", "column_names", "config_database",
+           "upgrade_database", "encode_datum", "decode_datum",
+           "to_epoch_us", "from_epoch_us", "SignalTable", "BulkWriter",
+           "RollupWriter", "ROLLUP_LEVELS", "rollup_table",
+           "DatabaseWriter", "drain_queue", "database_path"]
+
+SCHEMA_VERSION = 4
+
+#Rollup bucket widths in seconds, finest first
+ROLLUP_LEVELS = (1, 10, 60, 600)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#Largest integer that survives a round trip through a double
+MAX_EXACT_INT = 2**53
+
+INF = float("inf")
+
+def table_exists(conn, name):
+    cur = conn.cursor()
+    cur.execute('SELECT name FROM sqlite_master where name = ?;', (name,))
+    exists = cur.fetchone() != None
+    cur.close()
+    return exists
+
+def column_names(conn, table):
+    "Returns the list of column names of table"
+    return [row[1] for row in conn.execute("PRAGMA table_info(%s);" % table)]
+
+def database_path(conn):
+    """
+    Returns the file name of conn's main database, or a name unique to conn
+    for in-memory databases
+    """
+    for seq, name, path in conn.execute("PRAGMA database_list;"):
+        if name == "main" and path:
+            return path
+    return "memory:%x" % id(conn)
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+def set_version(conn, version):
+    conn.execute("PRAGMA user_version = %d;" % version)
+
+def drain_queue(queue):
+    """
+    Removes and returns every item currently in queue, which may be a Queue
+    or a deque. Items appended to a deque by another thread while it's being
+    drained are left for next time.
+    """
+    if isinstance(queue, collections.deque):
+        popleft = queue.popleft
+        return [popleft() for i in xrange(len(queue))]
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            return items
+
+def encode_datum(datum):
+    """
+    Splits a decoded datum into a (value, data) pair for the value and data
+    columns of the data table. Text that isn't valid UTF-8 is stored with
+    each byte escaped, since sqlite won't take 8-bit bytestrings.
+    """
+    if isinstance(datum, float):
+        if -INF < datum < INF:
+            return datum, None
+        return None, json.dumps(datum)
+    elif (isinstance(datum, (int, long)) and not isinstance(datum, bool)
+          and -MAX_EXACT_INT <= datum <= MAX_EXACT_INT):
+        return float(datum), None
+    try:
+        data = json.dumps(datum, ensure_ascii=False)
+        if isinstance(data, str):
+            data = data.decode("utf-8")
+    except UnicodeDecodeError:
+        data = json.dumps(datum, encoding="latin-1")
+    return None, data
+
+def to_epoch_us(dt):
+    "Converts a naive UTC datetime to integer microseconds since the epoch"
+    td = dt - EPOCH
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+def from_epoch_us(us):
+    "Inverse of to_epoch_us"
+    return EPOCH + datetime.timedelta(microseconds=us)
+
+def decode_datum(value, data):
+    "Inverse of encode_datum"
+    if value is not None:
+        return value
+    elif data is not None:
+        return json.loads(data)
+    else:
+        return None
+
+def config_database(conn, drop_tables=False, progress=None):
+    """
+    Sets up the database with the intervals, signals and data tables and
+    upgrades any existing tables to the current schema
+    """
+    cursor = conn.cursor()
+    if table_exists(conn, "intervals") and drop_tables:
+        cursor.execute("DROP TABLE intervals;")
+    if not table_exists(conn, "intervals"):
+        cursor.execute("CREATE TABLE intervals (name text, start timestamp, end timestamp);")
+
+    if table_exists(conn, "data") and drop_tables:
+        cursor.execute("DROP TABLE data;")
+        if table_exists(conn, "signals"):
+            cursor.execute("DROP TABLE signals;")
+        for level in ROLLUP_LEVELS:
+            cursor.execute("DROP TABLE IF EXISTS %s;" % rollup_table(level))
+    if not table_exists(conn, "data"):
+        create_signals_table(conn)
+        create_data_table(conn)
+        create_rollup_tables(conn)
+        set_version(conn, SCHEMA_VERSION)
+    conn.commit()
+    cursor.close()
+
+    upgrade_database(conn, progress)
+
+def upgrade_database(conn, progress=None):
+    """
+    Brings an existing database up to SCHEMA_VERSION. progress, if given, is
+    called with a status message before each step.
+    Returns the schema version the database had before the upgrade.
+    """
+    version = get_version(conn)
+    if version >= SCHEMA_VERSION:
+        return version
+
+    if not table_exists(conn, "data"):
+        #Nothing has been logged yet, so there's nothing to migrate
+        if progress:
+            progress("Creating the data tables")
+        create_signals_table(conn)
+        create_data_table(conn)
+        create_rollup_tables(conn)
+        set_version(conn, SCHEMA_VERSION)
+        conn.commit()
+        return version
+
+    if version < 1:
+        if progress:
+            progress("Moving numeric values out of JSON text into the value column")
+        upgrade_to_numeric_values(conn)
+        set_version(conn, 1)
+        conn.commit()
+
+    if version < 2:
+        if progress:
+            progress("Adding integer epoch timestamps and the signal/time index")
+        upgrade_to_epoch_index(conn)
+        set_version(conn, 2)
+        conn.commit()
+
+    if version < 3:
+        if progress:
+            progress("Moving signal names into the signals table")
+        upgrade_to_signal_table(conn)
+        set_version(conn, 3)
+        conn.commit()
+
+    if version < 4:
+        if progress:
+            progress("Building the rollup tables")
+        upgrade_to_rollups(conn)
+        set_version(conn, 4)
+        conn.commit()
+
+    return version
+
+def create_signals_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS signals"
+                 " (signal_id integer primary key, can_id integer,"
+                 " name text, units text, UNIQUE (can_id, name));")
+
+def create_data_table(conn, name="data"):
+    conn.execute("CREATE TABLE %s (signal_id integer, epoch integer, value real, data text);" % name)
+    conn.execute("CREATE INDEX %s_signal_epoch ON %s (signal_id, epoch);" % (name, name))
+
+def rollup_table(level):
+    "Returns the name of the rollup table for buckets of level seconds"
+    return "rollup_%d" % level
+
+def create_rollup_tables(conn):
+    for level in ROLLUP_LEVELS:
+        conn.execute("CREATE TABLE IF NOT EXISTS %s"
+                     " (signal_id integer, bucket integer, count integer,"
+                     " min real, max real, sum real, last real, last_epoch integer,"
+                     " PRIMARY KEY (signal_id, bucket));" % rollup_table(level))
+
+def upgrade_to_numeric_values(conn, batch_size=10000):
+    "Schema version 1: adds the value column and fills it from the data column"
+    if "value" not in column_names(conn, "data"):
+        conn.execute("ALTER TABLE data ADD COLUMN value real;")
+
+    last_rowid = -1
+    while True:
+        rows = conn.execute("SELECT rowid, data FROM data"
+                            " WHERE rowid > ? AND value IS NULL"
+                            " ORDER BY rowid LIMIT ?;",
+                            (last_rowid, batch_size)).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+
+        updates = []
+        for rowid, data in rows:
+            if data is None:
+                continue
+            try:
+                value, data = encode_datum(json.loads(data))
+            except ValueError:
+                continue
+            if value is not None:
+                updates.append((value, rowid))
+        conn.executemany("UPDATE data SET value = ?, data = NULL WHERE rowid = ?;", updates)
+        conn.commit()
+
+def upgrade_to_epoch_index(conn):
+    """
+    Schema version 2: adds the epoch column, fills it from the timestamp text
+    and indexes (id, name, epoch)
+    """
+    if "epoch" not in column_names(conn, "data"):
+        conn.execute("ALTER TABLE data ADD COLUMN epoch integer;")
+
+    #Timestamps are stored as 'YYYY-MM-DD HH:MM:SS[.ffffff]'. Appending
+    #'.000000' lets the fraction be read from the same offset either way.
+    conn.execute("UPDATE data SET epoch ="
+                 " CAST(strftime('%s', time) AS INTEGER) * 1000000"
+                 " + CAST(substr(time || '.000000', 21, 6) AS INTEGER)"
+                 " WHERE epoch IS NULL;")
+    conn.execute("CREATE INDEX IF NOT EXISTS data_signal_epoch ON data (id, name, epoch);")
+    conn.commit()
+
+def upgrade_to_signal_table(conn):
+    """
+    Schema version 3: replaces the id and name columns of the data table with
+    a signal_id referencing the signals table and drops the text timestamps.
+    The table is rebuilt, so run VACUUM afterwards to shrink the file.
+    """
+    create_signals_table(conn)
+    conn.execute("INSERT OR IGNORE INTO signals (can_id, name)"
+                 " SELECT DISTINCT id, name FROM data;")
+    conn.execute("DROP TABLE IF EXISTS data_v3;")
+    conn.execute("CREATE TABLE data_v3 (signal_id integer, epoch integer, value real, data text);")
+    conn.execute("INSERT INTO data_v3 (signal_id, epoch, value, data)"
+                 " SELECT signals.signal_id, data.epoch, data.value, data.data"
+                 " FROM data JOIN signals"
+                 " ON signals.can_id = data.id AND signals.name = data.name"
+                 " ORDER BY data.rowid;")
+    conn.execute("DROP TABLE data;")
+    conn.execute("ALTER TABLE data_v3 RENAME TO data;")
+    conn.execute("CREATE INDEX data_signal_epoch ON data (signal_id, epoch);")
+    conn.commit()
+
+class SignalTable:
+    """
+    In-memory copy of the signals table, mapping (can_id, name) pairs and
+    identifiers like "0x501:Motor Current" to integer signal_ids.
+
+    instance variables:
+        connection - the connection the signals table is read from and
+                     written to
+        ids        - dict of (can_id, name) -> signal_id
+        units      - dict of signal_id -> units
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.ids = {}
+        self.units = {}
+        self.reload()
+
+    def reload(self):
+        self.ids.clear()
+        self.units.clear()
+        for signal_id, can_id, name, units in self.connection.execute(
+            "SELECT signal_id, can_id, name, units FROM signals;"):
+            self.ids[(can_id, name)] = signal_id
+            self.units[signal_id] = units
+
+    def add_descriptors(self, desc_sets):
+        """
+        Adds every signal described in desc_sets, a list of
+        (source, descriptor set) pairs as loaded from the *.can.json files,
+        and updates the units of signals already in the table.
+        """
+        for source, desc_set in desc_sets:
+            for id_, descr in desc_set.items():
+                can_id = int(id_, 16)
+                for [name, units, desc] in descr.get("messages", []):
+                    signal_id = self.get(can_id, name, units)
+                    if self.units.get(signal_id) != units:
+                        self.connection.execute("UPDATE signals SET units = ? WHERE signal_id = ?;",
+                                                (units, signal_id))
+                        self.units[signal_id] = units
+        self.connection.commit()
+
+    def get(self, can_id, name, units=None):
+        "Returns the signal_id for (can_id, name), adding the signal if needed"
+        signal_id = self.ids.get((can_id, name))
+        if signal_id is None:
+            cursor = self.connection.execute("INSERT INTO signals (can_id, name, units) VALUES (?, ?, ?);",
+                                             (can_id, name, units))
+            signal_id = self.ids[(can_id, name)] = cursor.lastrowid
+            self.units[signal_id] = units
+        return signal_id
+
+    def find(self, can_id, name):
+        """
+        Returns the signal_id for (can_id, name) without adding it, or None if
+        no such signal has been recorded.
+        """
+        signal_id = self.ids.get((can_id, name))
+        if signal_id is None:
+            #Another connection may have added it since we were loaded
+            row = self.connection.execute("SELECT signal_id, units FROM signals"
+                                          " WHERE can_id = ? AND name = ?;",
+                                          (can_id, name)).fetchone()
+            if row is not None:
+                signal_id, self.units[signal_id] = row
+                self.ids[(can_id, name)] = signal_id
+        return signal_id
+
+    def lookup(self, identifier):
+        "Like find, but takes an identifier of the form '0x501:Motor Current'"
+        id_, name = identifier.split(":", 1)
+        return self.find(int(id_, 16), name)
+
+def upgrade_to_rollups(conn, batch_size=100000):
+    """
+    Schema version 4: creates the rollup tables and fills them from the
+    existing numeric data
+    """
+    create_rollup_tables(conn)
+    for level in ROLLUP_LEVELS:
+        conn.execute("DELETE FROM %s;" % rollup_table(level))
+
+    rollups = RollupWriter(conn)
+    cursor = conn.execute("SELECT signal_id, epoch, value, NULL FROM data"
+                          " WHERE value IS NOT NULL;")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        rollups.write(rows)
+    conn.commit()
+
+class RollupWriter:
+    """
+    Folds newly inserted data rows into the rollup tables.
+
+    Each batch is first aggregated in memory, 1 s buckets from the rows and
+    each coarser level from the one below it, and then merged into the
+    tables with one INSERT OR IGNORE and one UPDATE per bucket touched.
+    Out-of-order rows are handled: last only changes if the row is at least
+    as recent as the bucket's last_epoch.
+    """
+    insert_template = ("INSERT OR IGNORE INTO %s"
+                       " (signal_id, bucket, count, min, max, sum, last, last_epoch)"
+                       " VALUES (?, ?, 0, ?, ?, 0.0, ?, ?);")
+    update_template = ("UPDATE %s SET count = count + ?, sum = sum + ?,"
+                       " min = min(min, ?), max = max(max, ?),"
+                       " last = CASE WHEN ? >= last_epoch THEN ? ELSE last END,"
+                       " last_epoch = max(last_epoch, ?)"
+                       " WHERE signal_id = ? AND bucket = ?;")
+    def __init__(self, connection, levels=ROLLUP_LEVELS):
+        self.connection = connection
+        self.levels = levels
+
+    def write(self, rows):
+        "Adds the (signal_id, epoch, value, data) rows to the rollups"
+        #signal_id, bucket -> [count, min, max, sum, last, last_epoch]
+        buckets = {}
+        width = self.levels[0] * 1000000
+        for signal_id, epoch, value, data in rows:
+            if value is None or not -INF < value < INF:
+                continue
+            key = (signal_id, epoch // width)
+            b = buckets.get(key)
+            if b is None:
+                buckets[key] = [1, value, value, value, value, epoch]
+            else:
+                b[0] += 1
+                b[3] += value
+                if value < b[1]:
+                    b[1] = value
+                if value > b[2]:
+                    b[2] = value
+                if epoch >= b[5]:
+                    b[4] = value
+                    b[5] = epoch
+
+        previous = self.levels[0]
+        for level in self.levels:
+            if level != previous:
+                buckets = self.coarsen(buckets, level // previous)
+                previous = level
+            self.merge(level, buckets)
+
+    @staticmethod
+    def coarsen(buckets, factor):
+        coarser = {}
+        for (signal_id, bucket), (count, min_, max_, sum_, last, last_epoch) in buckets.iteritems():
+            key = (signal_id, bucket // factor)
+            b = coarser.get(key)
+            if b is None:
+                coarser[key] = [count, min_, max_, sum_, last, last_epoch]
+            else:
+                b[0] += count
+                b[3] += sum_
+                if min_ < b[1]:
+                    b[1] = min_
+                if max_ > b[2]:
+                    b[2] = max_
+                if last_epoch >= b[5]:
+                    b[4] = last
+                    b[5] = last_epoch
+        return coarser
+
+    def merge(self, level, buckets):
+        if not buckets:
+            return
+        table = rollup_table(level)
+        self.connection.executemany(self.insert_template % table,
+            [(signal_id, bucket, min_, max_, last, last_epoch)
+             for (signal_id, bucket), (count, min_, max_, sum_, last, last_epoch)
+             in buckets.iteritems()])
+        self.connection.executemany(self.update_template % table,
+            [(count, sum_, min_, max_, last_epoch, last, last_epoch, signal_id, bucket)
+             for (signal_id, bucket), (count, min_, max_, sum_, last, last_epoch)
+             in buckets.iteritems()])
+
+class BulkWriter:
+    """
+    Writes decoded (id, name, time, datum) messages to the data table with a
+    single executemany per batch instead of one execute per signal, and
+    updates the rollup tables to match. Committing is left to the owner of
+    the connection.
+    """
+    insert_command = "INSERT INTO data(signal_id, epoch, value, data) VALUES (?,?,?,?)"
+    def __init__(self, connection, signals=None):
+        self.connection = connection
+        if signals is None:
+            signals = SignalTable(connection)
+        self.signals = signals
+        self.rollups = RollupWriter(connection)
+        self.rows_written = 0
+
+    def write(self, messages):
+        "Inserts all of the (id, name, time, datum) tuples in messages"
+        rows = []
+        get_signal = self.signals.get
+        for id_, name, t, datum in messages:
+            value, data = encode_datum(datum)
+            rows.append((get_signal(id_, name), to_epoch_us(t), value, data))
+        return self.write_rows(rows)
+
+    def write_rows(self, rows):
+        "Inserts already encoded (signal_id, epoch, value, data) rows"
+        if rows:
+            self.connection.executemany(self.insert_command, rows)
+            self.rollups.write(rows)
+            self.rows_written += len(rows)
+        return len(rows)
+
+    def drain(self, queue):
+        "Removes every message currently in queue and writes them in one batch"
+        return self.write(drain_queue(queue))
+
+class DatabaseWriter(threading.Thread):
+    """
+    Persists decoded messages on a dedicated thread so that inserts and
+    commits never run on the serial ingest thread.
+
+    Batches of (id, name, time, datum) messages are handed over through a
+    bounded queue. The writer commits once commit_rows rows are pending or
+    the oldest uncommitted row is commit_latency seconds old, whichever
+    comes first. If the queue fills up, submit blocks the caller until
+    there's room again, counts the stall and warns through logger.
+
+    A batch that fails to write is logged and skipped. If the writer itself
+    fails (it can't open or commit to the database), failed is set and
+    submit and close drop their work with a warning instead of waiting on
+    a thread that has stopped.
+
+    instance variables:
+        path           - the database file, opened on the writer thread
+        queue          - bounded queue of message batches
+        commit_rows    - pending row count that forces a commit
+        commit_latency - seconds a row may wait before it is committed
+        rows_written   - total rows inserted so far
+        commits        - total commits so far
+        commit_time    - duration of the last commit in seconds
+        stalls         - number of times submit found the queue full
+        failed_batches - number of batches that couldn't be written
+        failed         - set once the writer thread has stopped on an error
+    """
+    def __init__(self, path, logger=None, max_batches=256,
+                 commit_rows=5000, commit_latency=1.0):
+        threading.Thread.__init__(self, name="DatabaseWriter")
+        self.daemon = True
+        self.path = path
+        self.logger = logger
+        self.queue = Queue(max_batches)
+        self.commit_rows = commit_rows
+        self.commit_latency = commit_latency
+
+        self.rows_written = 0
+        self.commits = 0
+        self.commit_time = 0.0
+        self.stalls = 0
+        self.backlogged = False
+        self.failed_batches = 0
+        self.failed = False
+        self.dropped = 0
+
+    def log(self, level, msg, *args):
+        if self.logger is not None:
+            getattr(self.logger, level)(msg, *args)
+
+    def put(self, item):
+        """
+        Puts item on the queue, waiting while it's full. Returns False,
+        without putting it, if the writer thread has failed.
+        """
+        while not self.failed:
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def submit(self, messages):
+        """
+        Queues a batch of messages to be written. Blocks while the writer
+        is max_batches batches behind.
+        """
+        if not messages:
+            return
+        if self.failed:
+            self.drop(messages)
+            return
+        try:
+            self.queue.put_nowait(messages)
+        except Full:
+            self.stalls += 1
+            if not self.backlogged:
+                self.log("warning", "Database writer is %d batches behind - ingest is waiting on it",
+                         self.queue.qsize())
+            self.backlogged = True
+            if not self.put(messages):
+                self.drop(messages)
+                return
+
+        if self.backlogged and self.queue.qsize() <= self.queue.maxsize // 2:
+            self.backlogged = False
+            self.log("info", "Database writer caught up")
+
+    def drop(self, messages):
+        if not self.dropped:
+            self.log("error", "Database writer has stopped - data is no longer being logged")
+        self.dropped += len(messages)
+
+    def drain(self, queue):
+        "Removes every message currently in queue and submits them as one batch"
+        self.submit(drain_queue(queue))
+
+    @property
+    def pending(self):
+        "Number of batches waiting to be written"
+        return self.queue.qsize()
+
+    def close(self):
+        "Writes and commits everything already submitted, then stops the thread"
+        if self.is_alive() and self.put(None):
+            self.join()
+        if self.dropped:
+            self.log("warning", "%d rows were dropped because the database writer stopped",
+                     self.dropped)
+
+    def run(self):
+        try:
+            self.write_batches()
+        except Exception as e:
+            self.failed = True
+            self.log("error", "Database writer stopped: %s", e)
+            #Let anyone blocked in put see the failure
+            drain_queue(self.queue)
+
+    def write_batches(self):
+        conn = sql.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        writer = BulkWriter(conn)
+
+        uncommitted = 0
+        oldest = None
+        try:
+            while True:
+                if oldest is None:
+                    timeout = None
+                else:
+                    timeout = max(0.0, oldest + self.commit_latency - time.time())
+                try:
+                    batch = self.queue.get(timeout=timeout)
+                except Empty:
+                    batch = []
+
+                if batch is None:
+                    break
+                if batch:
+                    try:
+                        uncommitted += writer.write(batch)
+                    except (sql.Error, ValueError, TypeError) as e:
+                        self.failed_batches += 1
+                        self.log("error", "Couldn't write a batch of %d rows to the database: %s",
+                                 len(batch), e)
+                    self.rows_written = writer.rows_written
+                    #Only start the commit clock once there's something to
+                    #commit, or a failed batch would leave the loop polling
+                    if uncommitted and oldest is None:
+                        oldest = time.time()
+
+                if uncommitted and (uncommitted >= self.commit_rows or
+                                    time.time() - oldest >= self.commit_latency):
+                    self.commit(conn)
+                    uncommitted = 0
+                    oldest = None
+        finally:
+            self.commit(conn)
+            conn.close()
+
+    def commit(self, conn):
+        start = time.time()
+        conn.commit()
+        self.commit_time = time.time() - start
+        self.commits += 1
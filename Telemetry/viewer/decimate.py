@@ -0,0 +1,58 @@
+"""
+Min/max envelope decimation for plotted series.
+
+A plot can't show more than a few points per pixel column, so pushing a
+full race day of samples through matplotlib is wasted work. envelope()
+splits the visible x range into one bucket per pixel and keeps only the
+first, last, minimum and maximum sample of each bucket (the M4 scheme).
+The line drawn from those points covers the same pixels as the line drawn
+from every sample, so spikes and dropouts are preserved.
+"""
+import numpy as np
+
+__all__ = ["envelope", "axes_buckets"]
+
+def axes_buckets(axes):
+    "Returns the number of buckets to use for axes: one per pixel of width"
+    return max(1, int(axes.bbox.width))
+
+def envelope(vertices, x0, x1, buckets):
+    """
+    Decimates an Nx2 array of (x, y) vertices, sorted by x, to at most four
+    vertices per bucket between x0 and x1. The vertices on either side of
+    the range are kept so lines still run off the edges of the plot.
+    Returns vertices unchanged if there is nothing to gain.
+    """
+    n = len(vertices)
+    if n <= 4 * buckets or x1 <= x0:
+        return vertices
+
+    xs = vertices[:, 0]
+    ys = vertices[:, 1]
+    lo = np.searchsorted(xs, x0, "left")
+    hi = np.searchsorted(xs, x1, "right")
+    if hi - lo <= 4 * buckets:
+        return vertices[max(lo-1, 0):hi+1]
+
+    ids = ((xs[lo:hi] - x0) * (float(buckets) / (x1 - x0))).astype(np.intp)
+    np.clip(ids, 0, buckets - 1, out=ids)
+    visible = ys[lo:hi]
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(ids)) + 1))
+    ends = np.concatenate((starts[1:], [len(ids)])) - 1
+    counts = ends - starts + 1
+
+    #Index of the first minimum and first maximum in each bucket. fmin and
+    #fmax skip NaNs, so a bucket of only NaNs just keeps its ends.
+    keep = [starts, ends]
+    for reduce_ in (np.fmin, np.fmax):
+        extreme = np.repeat(reduce_.reduceat(visible, starts), counts)
+        hits = np.flatnonzero(visible == extreme)
+        keep.append(hits[np.unique(ids[hits], return_index=True)[1]])
+
+    picked = np.unique(np.concatenate(keep)) + lo
+    if lo > 0:
+        picked = np.concatenate(([lo - 1], picked))
+    if hi < n:
+        picked = np.concatenate((picked, [hi]))
+    return vertices[picked]
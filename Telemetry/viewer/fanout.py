@@ -0,0 +1,363 @@
+"""
+Serves live telemetry to other machines over TCP.
+
+FanoutServer is fed every decoded sample by the stream and sends them on to
+any number of clients, such as the chase car or a second laptop in the pit.
+Clients choose the signals they want, and samples are sent in compact
+binary batches a few times a second. Each client has a bounded backlog; if a
+client can't keep up, its oldest batches are dropped rather than letting it
+hold up ingest or the other clients.
+
+Protocol - clients send newline-terminated commands:
+    subscribe IDENTIFIER     e.g. "subscribe 0x501:Motor Current", or
+                             "subscribe *" for every signal
+    unsubscribe IDENTIFIER
+
+The server sends messages, each a MESSAGE header of a kind byte and the
+length of the body, followed by the body:
+    "S" - defines a signal: a uint16 signal number, then its identifier
+          encoded as UTF-8
+    "B" - a batch of samples: SAMPLE records of a uint16 signal number,
+          a double of seconds since the Unix epoch and a double value
+
+A signal's definition is always sent before the first batch that uses it,
+and definitions are never dropped.
+
+Usage: python -m viewer.fanout HOST PORT [IDENTIFIER ...]
+prints samples from a running server, subscribing to everything if no
+identifiers are given.
+"""
+import collections
+import errno
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+from GraphData import NaN, to_epoch
+
+__all__ = ["FanoutServer", "FanoutClient", "MESSAGE", "SAMPLE"]
+
+MESSAGE = struct.Struct("<cI")
+SIGNAL = struct.Struct("<H")
+SAMPLE = struct.Struct("<Hdd")
+
+def pack_message(kind, body):
+    return MESSAGE.pack(kind, len(body)) + body
+
+class Subscriber(object):
+    """
+    The server's state for one client connection.
+
+    instance variables:
+        signals  - the identifiers the client subscribed to
+        everything - whether the client subscribed to "*"
+        defined  - the signal numbers whose definitions have been queued
+        outgoing - a deque of [data, droppable] messages waiting to be sent
+        offset   - how much of the first outgoing message has been sent
+        queued   - the number of bytes waiting in outgoing
+        dropped  - the number of batches dropped because the client lagged
+    """
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.signals = set()
+        self.everything = False
+        self.defined = set()
+        self.incoming = ""
+        self.outgoing = collections.deque()
+        self.offset = 0
+        self.queued = 0
+        self.dropped = 0
+        self.lagging = False
+
+    def wants(self, identifier):
+        return self.everything or identifier in self.signals
+
+    def enqueue(self, data, droppable, max_backlog):
+        """
+        Queues data to be sent. While more than max_backlog bytes are
+        waiting, the oldest droppable messages that haven't started being
+        sent are discarded. Returns the number discarded.
+        """
+        self.outgoing.append([data, droppable])
+        self.queued += len(data)
+        dropped = 0
+        if self.queued > max_backlog:
+            kept = collections.deque()
+            for i, message in enumerate(self.outgoing):
+                if (self.queued > max_backlog and message[1] and
+                    message is not self.outgoing[-1] and
+                    not (i == 0 and self.offset)):
+                    self.queued -= len(message[0])
+                    dropped += 1
+                else:
+                    kept.append(message)
+            self.outgoing = kept
+        self.dropped += dropped
+        return dropped
+
+    def send(self):
+        "Sends as much as the socket will take. Returns False if it closed"
+        while self.outgoing:
+            data = self.outgoing[0][0]
+            try:
+                sent = self.sock.send(data[self.offset:])
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                return False
+            self.offset += sent
+            self.queued -= sent
+            if self.offset < len(data):
+                return True
+            self.outgoing.popleft()
+            self.offset = 0
+        return True
+
+    def receive(self):
+        "Reads and applies commands. Returns False if the client closed"
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        if not data:
+            return False
+        lines = (self.incoming + data).split("\n")
+        self.incoming = lines.pop()
+        for line in lines:
+            command, _, identifier = line.strip().partition(" ")
+            identifier = identifier.strip()
+            if command == "subscribe":
+                if identifier == "*":
+                    self.everything = True
+                else:
+                    self.signals.add(identifier)
+            elif command == "unsubscribe":
+                if identifier == "*":
+                    self.everything = False
+                    self.signals.clear()
+                else:
+                    self.signals.discard(identifier)
+        return True
+
+class FanoutServer(threading.Thread):
+    """
+    A thread serving published samples to TCP clients.
+
+    publish may be called from any thread and only appends to a deque; the
+    server thread batches whatever has been published every batch_interval
+    seconds. A client with more than max_backlog bytes waiting has its
+    oldest batches dropped. Once the server thread has stopped, whether
+    closed or because of an error, publish does nothing.
+    """
+    def __init__(self, address, logger=None, batch_interval=0.05,
+                 max_backlog=2**20):
+        threading.Thread.__init__(self, name="Telemetry fan-out")
+        self.daemon = True
+        self.logger = logger
+        self.batch_interval = batch_interval
+        self.max_backlog = max_backlog
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(8)
+        self.listener.setblocking(0)
+        self.address = self.listener.getsockname()
+
+        self.pending = collections.deque()
+        self.numbers = {}
+        self.definitions = {}
+        self.subscribers = {}
+        self.running = True
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, identifier, t, value):
+        "Queues one sample to be sent to the clients subscribed to identifier"
+        if not self.running:
+            return
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = NaN
+        self.pending.append((identifier, to_epoch(t), value))
+
+    def close(self):
+        self.running = False
+        if self.is_alive():
+            self.join()
+
+    def log(self, level, msg, *args):
+        if self.logger is not None:
+            getattr(self.logger, level)(msg, *args)
+
+    def run(self):
+        last_flush = time.time()
+        try:
+            while self.running:
+                socks = [self.listener] + self.subscribers.keys()
+                waiting = [sock for (sock, sub) in self.subscribers.items()
+                           if sub.outgoing]
+                timeout = max(0.0, last_flush + self.batch_interval - time.time())
+                readable, writable, broken = select.select(socks, waiting, [], timeout)
+                for sock in readable:
+                    if sock is self.listener:
+                        self.accept()
+                    elif sock in self.subscribers and not self.subscribers[sock].receive():
+                        self.disconnect(sock)
+                for sock in writable:
+                    if sock in self.subscribers and not self.subscribers[sock].send():
+                        self.disconnect(sock)
+                if time.time() - last_flush >= self.batch_interval:
+                    self.flush()
+                    last_flush = time.time()
+        except Exception as e:
+            self.log("error", "Fan-out server stopped: %s", e)
+        finally:
+            self.running = False
+            self.pending.clear()
+            for sock in self.subscribers.keys():
+                self.disconnect(sock)
+            self.listener.close()
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.subscribers[sock] = Subscriber(sock, address)
+        self.log("info", "Fan-out client %s:%d connected", *address)
+
+    def disconnect(self, sock):
+        sub = self.subscribers.pop(sock)
+        sock.close()
+        self.log("info", "Fan-out client %s:%d disconnected (%d batches dropped)",
+                 sub.address[0], sub.address[1], sub.dropped)
+
+    def number(self, identifier):
+        number = self.numbers.get(identifier)
+        if number is None:
+            number = self.numbers[identifier] = len(self.numbers)
+            if isinstance(identifier, unicode):
+                name = identifier.encode("utf-8")
+            else:
+                name = identifier
+            self.definitions[number] = pack_message("S", SIGNAL.pack(number) + name)
+        return number
+
+    def flush(self):
+        "Sends everything published since the last flush to its subscribers"
+        pending = self.pending
+        if not pending:
+            return
+        by_signal = collections.defaultdict(list)
+        for i in xrange(len(pending)):
+            identifier, t, value = pending.popleft()
+            by_signal[identifier].append(SAMPLE.pack(self.number(identifier), t, value))
+            self.published += 1
+        if not self.subscribers:
+            return
+
+        everything = None
+        for sub in self.subscribers.values():
+            if sub.everything:
+                identifiers = by_signal.keys()
+            else:
+                identifiers = [ident for ident in by_signal if ident in sub.signals]
+            if not identifiers:
+                continue
+            for identifier in identifiers:
+                number = self.numbers[identifier]
+                if number not in sub.defined:
+                    sub.defined.add(number)
+                    sub.enqueue(self.definitions[number], False, self.max_backlog)
+            if sub.everything:
+                if everything is None:
+                    everything = pack_message("B", "".join("".join(records)
+                                                           for records in by_signal.values()))
+                batch = everything
+            else:
+                batch = pack_message("B", "".join("".join(by_signal[ident])
+                                                  for ident in identifiers))
+            dropped = sub.enqueue(batch, True, self.max_backlog)
+            if dropped:
+                self.dropped += dropped
+                if not sub.lagging:
+                    sub.lagging = True
+                    self.log("warning", "Fan-out client %s:%d is lagging - dropping its oldest batches",
+                             *sub.address)
+            elif sub.lagging and sub.queued <= self.max_backlog // 2:
+                sub.lagging = False
+                self.log("info", "Fan-out client %s:%d caught up", *sub.address)
+
+class FanoutClient(object):
+    "A blocking client for FanoutServer"
+    def __init__(self, address, timeout=None):
+        self.sock = socket.create_connection(address, timeout)
+        self.buffer = ""
+        self.names = {}
+
+    def subscribe(self, *identifiers):
+        self.sock.sendall("".join("subscribe %s\n" % ident for ident in identifiers))
+
+    def unsubscribe(self, *identifiers):
+        self.sock.sendall("".join("unsubscribe %s\n" % ident for ident in identifiers))
+
+    def read(self):
+        """
+        Waits for data from the server and returns the samples it contained
+        as (identifier, epoch seconds, value) tuples. Returns None once the
+        server has closed the connection.
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            return None
+        self.buffer += data
+        samples = []
+        offset = 0
+        while len(self.buffer) - offset >= MESSAGE.size:
+            kind, length = MESSAGE.unpack_from(self.buffer, offset)
+            start = offset + MESSAGE.size
+            if len(self.buffer) - start < length:
+                break
+            if kind == "S":
+                (number,) = SIGNAL.unpack_from(self.buffer, start)
+                self.names[number] = self.buffer[start+SIGNAL.size:start+length].decode("utf-8")
+            elif kind == "B":
+                for i in xrange(start, start + length, SAMPLE.size):
+                    number, t, value = SAMPLE.unpack_from(self.buffer, i)
+                    samples.append((self.names.get(number), t, value))
+            offset = start + length
+        self.buffer = self.buffer[offset:]
+        return samples
+
+    def close(self):
+        self.sock.close()
+
+def main(args):
+    if len(args) < 2:
+        print __doc__
+        return 1
+    client = FanoutClient((args[0], int(args[1])))
+    client.subscribe(*(args[2:] or ["*"]))
+    try:
+        while True:
+            samples = client.read()
+            if samples is None:
+                break
+            for identifier, t, value in samples:
+                print "%.3f %s = %r" % (t, identifier, value)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,123 @@
+"""
+Helpers for the viewer's loggers.
+
+The stream logs every packet it decodes, which at full rate is far more than
+anyone can read and more than the console can keep up with. Loggers pass
+messages that come from a source, such as a CAN id, through a RateLimiter,
+which lets a few through from each source per interval and turns the rest
+into a summary like "0x501: 1200 packets in last 5 s". Messages are written
+to the day's log file by a LogFileWriter thread, so a slow disk never holds
+up the thread doing the logging.
+
+Sources are given the same way as extra attributes for the standard logging
+module, e.g. logger.info("Got %s", x, extra={"source": "0x501"}).
+"""
+import collections
+import datetime
+import threading
+import time
+
+__all__ = ["RateLimiter", "LogFileWriter", "message_source"]
+
+def message_source(kwargs):
+    "Removes the extra argument from a logging call's kwargs and returns its source"
+    extra = kwargs.pop("extra", None)
+    if extra:
+        return extra.get("source")
+    return None
+
+class RateLimiter(object):
+    """
+    Counts messages per source over fixed intervals. allow returns True for
+    the first burst messages from a source in each interval and False for
+    the rest; summaries ends the interval once it's over and describes the
+    sources that went over.
+
+    allow may be called from any thread.
+    """
+    summary_format = "%s: %d packets in last %.0f s"
+
+    def __init__(self, interval=5.0, burst=5):
+        self.interval = interval
+        self.burst = burst
+        self.counts = collections.defaultdict(int)
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self, source):
+        with self.lock:
+            self.counts[source] += 1
+            return self.counts[source] <= self.burst
+
+    def summaries(self, now=None):
+        """
+        Returns a summary line for each source that had messages held back,
+        and starts a new interval, if the current one is over. Otherwise
+        returns an empty list.
+        """
+        if now is None:
+            now = time.time()
+        elapsed = now - self.started
+        if elapsed < self.interval:
+            return []
+        with self.lock:
+            counts, self.counts = self.counts, collections.defaultdict(int)
+            self.started = now
+        return [self.summary_format % (source, count, elapsed)
+                for (source, count) in sorted(counts.items())
+                if count > self.burst]
+
+class LogFileWriter(threading.Thread):
+    """
+    Appends lines to a log file named after the day they were written
+    ("2011-06-20.log" by default) from a background thread. write only
+    appends to a deque; the thread writes whatever has built up every
+    flush_interval seconds.
+    """
+    def __init__(self, name_format="%Y-%m-%d.log", flush_interval=1.0):
+        threading.Thread.__init__(self, name="Log file writer")
+        self.daemon = True
+        self.name_format = name_format
+        self.flush_interval = flush_interval
+        self.pending = collections.deque()
+        self.file = None
+        self.path = None
+        self.running = True
+        self.wakeup = threading.Event()
+
+    def write(self, line):
+        self.pending.append(line)
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
+        #Lines may have been written while the thread was making its last
+        #flush
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        pending = self.pending
+        lines = [pending.popleft() for i in xrange(len(pending))]
+        if not lines:
+            return
+        path = datetime.date.today().strftime(self.name_format)
+        try:
+            if path != self.path:
+                if self.file is not None:
+                    self.file.close()
+                self.file = open(path, "a")
+                self.path = path
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+        except (IOError, OSError) as e:
+            print "Error while writing to %s: %s" % (path, e)
@@ -0,0 +1,214 @@
+"""
+Recording and replaying the raw serial stream.
+
+CaptureRecorder wraps a serial port and tees every chunk read from it into a
+capture file along with the time it was read. ReplayPort reads a capture
+back through the same read interface TransparentStream uses, either at the
+speed it was recorded, some multiple of that, or as fast as it's read, so
+the whole ingest-to-plot pipeline can be exercised without the car.
+
+A capture file is the MAGIC string followed by one record per read: a
+RECORD header of the time of the read in seconds since the Unix epoch and
+the length of the data, followed by the data.
+
+Usage:
+    python -m viewer.replay FILE [SPEED]
+        decodes a capture as fast as possible (or at SPEED times real time)
+        and reports the throughput
+    python -m viewer.replay --make FILE [SECONDS] [FRAMES_PER_SECOND]
+        writes a capture of random frames for the configured CAN messages
+"""
+import glob
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+from database import drain_queue
+from sample import START_BYTE, escape, TransparentMessageDecoder, TransparentStream
+
+__all__ = ["CaptureRecorder", "ReplayPort", "MAGIC", "RECORD"]
+
+MAGIC = "CALSOL-CAPTURE-1\n"
+RECORD = struct.Struct("<dI")
+
+class CaptureRecorder(object):
+    """
+    A serial port wrapper that records everything read from the port to a
+    capture file. Writes to the port, like the XBee's association and
+    heartbeat frames, aren't recorded. Anything other than read and close
+    is passed through to the port.
+    """
+    def __init__(self, port, path, flush_interval=1.0):
+        self.port = port
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        self.bytes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        if data:
+            self.record(data)
+        return data
+
+    def write(self, data):
+        "Sends data to the port"
+        return self.port.write(data)
+
+    def record(self, data, t=None):
+        "Appends a record of data read at t (by default, now) to the capture"
+        if t is None:
+            t = time.time()
+        self.file.write(RECORD.pack(t, len(data)))
+        self.file.write(data)
+        self.bytes += len(data)
+        if t - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = t
+
+    def close(self):
+        self.file.close()
+        if self.port is not None:
+            self.port.close()
+
+class ReplayPort(object):
+    """
+    Replays a capture file through the read interface of a serial port.
+
+    With a speed of 1, each record becomes readable as long after the first
+    as it was recorded; with a speed of N, N times sooner. A speed of None
+    or 0 makes everything readable at once. Like a port with a zero
+    timeout, read never waits - it returns whatever is due, up to size
+    bytes, and an empty string once the capture is used up (unless loop is
+    set, in which case it starts again from the beginning).
+    """
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.portstr = "replay:%s" % path
+        self.speed = speed
+        self.loop = loop
+        self.file = open(path, "rb")
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s isn't a capture file" % path)
+        self.rewind()
+
+    def rewind(self):
+        self.file.seek(len(MAGIC))
+        self.buffer = ""
+        self.next_record = None
+        self.first_time = None
+        self.started = None
+        self.finished = False
+
+    def read_record(self):
+        header = self.file.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return None
+        t, length = RECORD.unpack(header)
+        return t, self.file.read(length)
+
+    def read(self, size=1):
+        if self.started is None:
+            self.started = time.time()
+        if self.speed:
+            due = (time.time() - self.started) * self.speed
+        while len(self.buffer) < size:
+            if self.next_record is None:
+                self.next_record = self.read_record()
+                if self.next_record is None:
+                    if self.loop and self.first_time is not None:
+                        self.rewind()
+                        self.started = time.time()
+                        due = 0.0
+                        continue
+                    self.finished = True
+                    break
+            t, data = self.next_record
+            if self.first_time is None:
+                self.first_time = t
+            if self.speed and t - self.first_time > due:
+                break
+            self.buffer += data
+            self.next_record = None
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+    def close(self):
+        self.file.close()
+
+def make_capture(path, mappings, seconds=60.0, rate=500, seed=0):
+    "Writes a capture of random frames for the messages described in mappings"
+    rng = random.Random(seed)
+    layouts = TransparentMessageDecoder(mappings).layouts.values()
+    layouts = [layout for layout in layouts if layout.struct is not None and layout.names]
+    #Text fields get printable characters
+    payload_bytes = [chr(i) for i in xrange(256)]
+    text_bytes = [chr(i) for i in xrange(32, 127)]
+    recorder = CaptureRecorder(None, path)
+    start = time.time()
+    chunk = []
+    for i in xrange(int(seconds * rate)):
+        layout = rng.choice(layouts)
+        if "s" in layout.struct.format or "c" in layout.struct.format:
+            choices = text_bytes
+        else:
+            choices = payload_bytes
+        payload = "".join(rng.choice(choices) for j in xrange(layout.size))
+        preamble = struct.pack("<H", (layout.id << 4) | layout.size)
+        chunk.append(chr(START_BYTE) + escape(preamble + payload))
+        if len(chunk) >= rate // 20 or i == int(seconds * rate) - 1:
+            recorder.record("".join(chunk), start + float(i) / rate)
+            chunk = []
+    recorder.close()
+
+class NullLogger(object):
+    def info(self, msg, *args, **kwargs):
+        pass
+    warning = error = critical = info
+
+def main(args):
+    mappings = []
+    for fname in glob.glob(os.path.join("config", "*.can.json")):
+        with open(fname) as f:
+            mappings.append(json.load(f))
+
+    if args[:1] == ["--make"] and len(args) > 1:
+        seconds = float(args[2]) if len(args) > 2 else 60.0
+        rate = int(args[3]) if len(args) > 3 else 500
+        make_capture(args[1], mappings, seconds, rate)
+        print "Wrote %d frames to %s" % (int(seconds * rate), args[1])
+        return 0
+    elif not args:
+        print __doc__
+        return 1
+
+    speed = float(args[1]) if len(args) > 1 else None
+    port = ReplayPort(args[0], speed)
+    stream = TransparentStream(TransparentMessageDecoder(mappings), NullLogger(), port)
+    start = time.time()
+    samples = 0
+    while not port.finished:
+        stream.process()
+        samples += len(drain_queue(stream.msg_queue))
+        for source in stream.data_table.values():
+            source.pull()
+    elapsed = time.time() - start
+    size = port.file.tell()
+    print "Replayed %d bytes in %.2fs - %.2f MB/s, %d samples in %d signals" % (
+        size, elapsed, size / elapsed / 2**20, samples, len(stream.data_table))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
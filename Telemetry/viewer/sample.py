@@ -3,8 +3,7 @@ import datetime
 import time
 import traceback
 
-from collections import defaultdict
-from Queue import PriorityQueue
+from collections import defaultdict, deque
 
 import serial
 
@@ -15,6 +14,7 @@ import json
 
 from xbee import XBee
 
+from database import drain_queue
 from GraphData import GraphData
 
 class DataSource(object):
@@ -25,6 +25,8 @@ class DataSource(object):
 
     class variables:
         sources - a mapping from signal-names to all live data sources
+        reorder_window - seconds that samples are held back in the GraphData
+                         to put them in order - see GraphData
 
     class methods:
         find - Either finds the existing data source for some signal name,
@@ -35,22 +37,29 @@ class DataSource(object):
                 id-in-hex:message-name. For example, the identifier for
                 the Tritium Motor Drive Command Motor current is
                 "0x501:Motor Current"
-        queue - the internal data queue that the data source uses to pull
-                data from the stream in a thread-safe manner
-        data  - the GraphData object that handles filtering (not used right now)
-                and storing the data for use with collections
+        queue - a deque of samples put by the stream and not yet pulled.
+                Appending and popping from a deque are atomic, so the
+                stream's thread and the puller's don't need a lock
+        data  - the GraphData ring buffer holding the most recent samples
+                for use with collections
+        version - incremented every time pull copies new samples into data,
+                  so plots can tell whether they have anything to redraw
 
     method summary:
-        push  - notifies all listeners that new data is pending and copies
-                any data from the internal queue to the GraphData storage
-        pull  - pulls all data from a queue into the internal data queue.
-                Intended for initializing with accumulated data
+        put   - queues a sample from the stream
+        pull  - copies every queued sample to the GraphData storage as one
+                batch
+        late  - the number of samples that arrived too late to be put in
+                order
     """
+    reorder_window = 0.5
+
     def __init__(self, identifier, desc=None):
         self.name = identifier
-        self.queue = PriorityQueue()
-        self.data = GraphData([])
+        self.queue = deque()
+        self.data = GraphData([], reorder_window=self.reorder_window)
         self.descriptor = desc
+        self.version = 0
 
         self.last_received = datetime.datetime(1993, 6, 20)
 
@@ -63,17 +72,71 @@ class DataSource(object):
     def put(self, point):
         "Add data from the stream to the internal data queue"
         time, datum = point
-        self.queue.put(point)
+        self.queue.append(point)
         self.last_received = max(self.last_received, time)
 
     def pull(self):
         "Adds all of the data from the stream's queue to its internal queue"
-        while not self.queue.empty():
-            self.data.addPoint(self.queue.get_nowait())
+        added = self.data.addPoints(drain_queue(self.queue))
+        #Let out samples the window has been holding once they're old enough
+        #even if nothing newer has come in
+        added += self.data.release(time.time())
+        if added:
+            self.version += 1
+
+    @property
+    def late(self):
+        return self.data.late
 
     def __repr__(self):
         return "DataSource(%r)" % self.name
 
+class MessageLayout(object):
+    """
+    Precompiled decoding information for a single CAN message descriptor,
+    built once when the descriptor is added so that decoding a frame does not
+    have to rebuild and re-parse the struct format string.
+
+    instance variables:
+        id          - the CAN ID as an integer
+        descriptor  - the CAN message descriptor dictionary
+        struct      - the struct.Struct for the payload, or None if the
+                      descriptor has no usable format
+        error       - why struct is None, reported when a frame is decoded
+        size        - the expected payload length in bytes
+        names       - a tuple of the message names in the payload
+        identifiers - a tuple of the signal identifiers in the payload, in
+                      the format id-in-hex:message-name
+    """
+    __slots__ = ["id", "descriptor", "struct", "error", "size", "names", "identifiers"]
+    def __init__(self, id_, desc):
+        self.id = id_
+        self.descriptor = desc
+        self.struct = self.size = self.error = None
+        if "format" not in desc:
+            self.error = "No format specified for %#x:%s" % (id_, desc["name"])
+        else:
+            try:
+                self.struct = struct.Struct("<" + str(desc["format"]))
+                self.size = self.struct.size
+            except struct.error as e:
+                self.error = ("Bad format %r specified for %#x:%s - %s"
+                              % (str(desc["format"]), id_, desc["name"], e))
+        self.names = tuple(msg_desc[0] for msg_desc in desc.get("messages", []))
+        self.identifiers = tuple("%#x:%s" % (id_, name) for name in self.names)
+
+    def unpack_from(self, msg, offset, length):
+        "Unpacks the payload of length bytes starting at offset in msg"
+        if self.struct is None:
+            raise ValueError(self.error)
+        if length != self.size:
+            raise ValueError("Error in decoding message id=%#x name=%s - length field %d mismatches descriptor %d"
+                             % (self.id, self.descriptor["name"], length, self.size))
+        if len(msg) < offset + length:
+            raise ValueError("Message id=%#x name=%s is truncated - expected %d bytes of payload, got %d bytes"
+                             % (self.id, self.descriptor["name"], length, len(msg) - offset))
+        return self.struct.unpack_from(msg, offset)
+
 class XOMBIEDecoder:
     """
     Handles reading and decoding XBee Omnidirectional Message Based
@@ -118,8 +181,11 @@ class XOMBIEDecoder:
     ID_MASK =  0xfff0
     LEN_MASK = 0x000f
 
+    HEADER = struct.Struct("<HL")
+
     def __init__(self, mappings=None):
         self.descriptors = {}
+        self.layouts = {}
         mappings = mappings if mappings else []
         for mapping in mappings:
             self.add_descriptors(mapping)
@@ -179,10 +245,18 @@ class XOMBIEDecoder:
               DESC is the CAN message descriptor dictionary
               DATA is a tuple of data values from the message
         """
-        if len(msg) < 6:
-            raise ValueError("Data message is too short - minimum length 6 bytes, got %d bytes" % len(msg))
+        TIME, ID, desc, DATA, LEN = self.decode_one(msg, 0)
+        return (TIME, ID, desc, DATA)
+
+    def decode_one(self, msg, offset):
+        """
+        Decodes the XOMBIE data message starting at offset in msg and returns
+        a tuple of (TIME, ID, DESC, DATA, LEN) where LEN is the payload length
+        """
+        if len(msg) - offset < 6:
+            raise ValueError("Data message is too short - minimum length 6 bytes, got %d bytes" % (len(msg) - offset))
 
-        (x, TIME) = struct.unpack("<HL", msg[0:6])
+        (x, TIME) = self.HEADER.unpack_from(msg, offset)
 
         if x & (2**15) != 0:
             raise ValueError("Expected a data message, found a command message instead")
@@ -192,49 +266,22 @@ class XOMBIEDecoder:
 
         if LEN < 0 or LEN > 8:
             raise ValueError("Invalid CAN payload length - %d bytes not in [0,8] bytes" % LEN)
-        
-        if ID in self.descriptors:
-            desc = self.descriptors[ID]
-            if "format" not in desc:
-                raise ValueError("No format specified for %#x:%s" % (ID, desc["name"]))
-            if LEN != struct.calcsize("<" + str(desc["format"])):
-                raise ValueError("Error in decoding message id=%#x name=%s - length field %d mismatches descriptor %d"
-                                 % (ID, desc["name"], LEN, struct.calcsize("<" + str(desc["format"]))))
-
-            DATA = struct.unpack("<" + str(desc["format"]), msg[6:6+LEN])
-            
-            return (TIME, ID, desc, DATA)
-        else:
-            raise ValueError("Unknown message id=%#x, time=%d, len=%d, data=%r" % (ID, TIME, LEN, msg[6:]))
-
-    def decode_multi(self, msg):
-        while msg:
-            if len(msg) < 6:
-                raise ValueError("Data message is too short - minimum length 6 bytes, got %d bytes" % len(msg))
-
-            (x, TIME) = struct.unpack("<HL", msg[0:6])
 
-            if x & (2**15) != 0:
-                raise ValueError("Expected a data message, found a command message instead")
+        layout = self.layouts.get(ID)
+        if layout is None:
+            raise ValueError("Unknown message id=%#x, time=%d, len=%d, data=%r"
+                             % (ID, TIME, LEN, str(bytearray(msg[offset+6:]))))
 
-            ID = (x & self.ID_MASK) >> 4
-            LEN = x & self.LEN_MASK
+        DATA = layout.unpack_from(msg, offset + 6, LEN)
+        return (TIME, ID, layout.descriptor, DATA, LEN)
 
-            if LEN < 0 or LEN > 8:
-                raise ValueError("Invalid CAN payload length - %d bytes not in [0,8] bytes" % LEN)
-            
-            if ID in self.descriptors:
-                desc = self.descriptors[ID]
-                if LEN != struct.calcsize("<" + str(desc["format"])):
-                    raise ValueError("Error in decoding message id=%#x name=%s - length field %d mismatches descriptor %d"
-                                     % (ID, desc["name"], LEN, struct.calcsize("<" + str(desc["format"]))))
-
-                DATA = struct.unpack("<" + str(desc["format"]), msg[6:6+LEN])
-                
-                yield (TIME, ID, desc, DATA)
-                msg = msg[6+LEN:]
-            else:
-                raise ValueError("Unknown message id=%#x, time=%d, len=%d, data=%r" % (ID, TIME, LEN, msg[6:]))
+    def decode_multi(self, msg):
+        offset = 0
+        end = len(msg)
+        while offset < end:
+            TIME, ID, desc, DATA, LEN = self.decode_one(msg, offset)
+            yield (TIME, ID, desc, DATA)
+            offset += 6 + LEN
             
     def add_descriptors(self, mapping):
         """
@@ -242,14 +289,19 @@ class XOMBIEDecoder:
         and adds it to the decoder's internal descriptor table.
         """
         for key, desc in mapping.iteritems():
-            self.descriptors[int(key, 16)] = desc
+            id_ = int(key, 16)
+            self.descriptors[id_] = desc
+            self.layouts[id_] = MessageLayout(id_, desc)
 
 class TransparentMessageDecoder:
     ID_MASK =  0xfff0
     LEN_MASK = 0x000f
+
+    PREAMBLE = struct.Struct("<H")
     
     def __init__(self, mappings=None):
         self.descriptors = {}
+        self.layouts = {}
         mappings = mappings if mappings else []
         for mapping in mappings:
             self.add_descriptors(mapping)
@@ -265,9 +317,8 @@ class TransparentMessageDecoder:
         """
         if len(msg) < 2:
             raise ValueError("Message is too short - can't fit a preamble")
-        preamble = msg[:2]
         
-        (x,) = struct.unpack("<H", preamble)
+        (x,) = self.PREAMBLE.unpack_from(msg, 0)
         
         ID = (x & self.ID_MASK) >> 4
         LEN = x & self.LEN_MASK
@@ -276,31 +327,48 @@ class TransparentMessageDecoder:
             raise ValueError("Invalid CAN payload length - %d bytes not in [0,8] bytes" % LEN)
 
         TIME = datetime.datetime.utcnow()
-        
-        if ID in self.descriptors:
-            desc = self.descriptors[ID]
-            if "format" not in desc:
-                raise ValueError("No format specified for %#x:%s" % (ID, desc["name"]))
-            if LEN != struct.calcsize("<" + str(desc["format"])):
-                raise ValueError("Error in decoding message id=%#x name=%s - length field %d mismatches descriptor %d"
-                                 % (ID, desc["name"], LEN, struct.calcsize("<" + str(desc["format"]))))
-
-            DATA = struct.unpack("<" + str(desc["format"]), msg[2:2+LEN])
-            
-            return (TIME, ID, desc, DATA)
-        else:
-            raise ValueError("Unknown message id=%#x, len=%d, data=%r" % (ID, LEN, msg[2:]))
+
+        layout = self.layouts.get(ID)
+        if layout is None:
+            raise ValueError("Unknown message id=%#x, len=%d, data=%r" % (ID, LEN, str(bytearray(msg[2:]))))
+
+        DATA = layout.unpack_from(msg, 2, LEN)
+        return (TIME, ID, layout.descriptor, DATA)
+
     def add_descriptors(self, mapping):
         """
         Takes a dictionary mapping from string ID constants to message field data
         and adds it to the decoder's internal descriptor table.
         """
         for key, desc in mapping.iteritems():
-            self.descriptors[int(key, 16)] = desc
+            id_ = int(key, 16)
+            self.descriptors[id_] = desc
+            self.layouts[id_] = MessageLayout(id_, desc)
 
 START_BYTE  = 0xE7
 ESCAPE_BYTE = 0x75
+
+def escape(data):
+    "Byte-stuffs data the same way the transparent stream firmware does"
+    start, esc = chr(START_BYTE), chr(ESCAPE_BYTE)
+    return (data.replace(esc, esc + chr(ESCAPE_BYTE ^ ESCAPE_BYTE))
+                .replace(start, esc + chr(START_BYTE ^ ESCAPE_BYTE)))
+
 class TransparentStreamDecoder(codecs.IncrementalDecoder):
+    """
+    Incremental decoder that removes the byte-stuffing from the transparent
+    serial stream. Every escaped byte is sent as the escape byte followed by
+    the original byte XOR'd with the escape byte.
+
+    decode works on a whole read chunk at a time: the chunk is split on the
+    escape byte and only the byte following each escape is translated
+    through a precomputed XOR table, so the per-byte work happens in C.
+    decode_bytewise is the original byte-at-a-time implementation and is
+    kept as a reference for testing and benchmarking.
+
+    Whether the last byte of a chunk was an escape byte is carried over to
+    the next chunk and is exposed through getstate/setstate.
+    """
     def __init__(self, errors  = 'strict',
                  escaped_bytes = [bytes(chr(START_BYTE)), bytes(chr(ESCAPE_BYTE))],
                  escape_byte   = bytes(chr(ESCAPE_BYTE))):
@@ -310,7 +378,55 @@ class TransparentStreamDecoder(codecs.IncrementalDecoder):
         self.escape_value  = ord(escape_byte)
         self.escape_next   = False
 
+        #Lookup table for XOR'ing a byte with the escape byte and the
+        #set of bytes that may legally follow an escape byte
+        self.unescape_table = "".join(chr(i ^ self.escape_value) for i in xrange(256))
+        self.escape_codes = "".join(b.translate(self.unescape_table) for b in self.escaped_bytes)
+
     def decode(self, obj, final=False):
+        table = self.unescape_table
+        escape_next = self.escape_next
+        output = []
+        escaped = []
+        for i, part in enumerate(bytes(obj).split(self.escape_byte)):
+            #Every part after the first was preceded by an escape byte
+            if i:
+                if escape_next:
+                    #The escape byte was itself the escaped byte
+                    escaped.append(self.escape_byte)
+                    output.append(self.escape_byte.translate(table))
+                    escape_next = False
+                else:
+                    escape_next = True
+            if part:
+                if escape_next:
+                    escaped.append(part[0])
+                    output.append(part[0].translate(table))
+                    output.append(part[1:])
+                    escape_next = False
+                else:
+                    output.append(part)
+
+        if escaped and self.errors == 'strict':
+            codes = "".join(escaped)
+            if codes.translate(None, self.escape_codes):
+                byte = codes.translate(None, self.escape_codes)[0]
+                raise ValueError("Got an unexpected value while unescaping. %#2x %#2x -> %#2x is not a required escape sequence"
+                                 % (ord(self.escape_byte), ord(byte), ord(byte) ^ self.escape_value))
+
+        self.escape_next = escape_next
+        if final and self.escape_next:
+            if self.errors == 'strict':
+                raise ValueError("Bad data stream - got EOF before finding the escaped byte after an indicator escape byte")
+            elif self.errors == 'ignore':
+                pass
+            elif self.errors == 'replace':
+                pass
+
+        return "".join(output)
+
+    def decode_bytewise(self, obj, final=False):
+        "Reference implementation of decode that handles one byte at a time"
         output = ""
         for byte in obj:
             if self.escape_next:
@@ -348,65 +464,154 @@ class TransparentStreamDecoder(codecs.IncrementalDecoder):
 
     def setstate(self, state):
         buf, self.escape_next = state
-    
+
+class FrameBuffer(object):
+    """
+    Accumulates the raw (still escaped) stream data and splits it into frames
+    separated by a start byte without copying the frame contents. The start
+    byte is always escaped inside a frame, so the boundaries have to be found
+    before unescaping - an escaped start byte in a payload would otherwise end
+    the frame early.
+
+    The data is kept in a single reusable bytearray. Consumed bytes are only
+    discarded (by one memmove) when new data is appended, and complete frames
+    are handed out as memoryview slices into the buffer, so splitting a read
+    containing N frames is a single linear pass instead of N re-slices.
+
+    The frame views returned by frames() are only valid until the next call
+    to extend(). If a caller still holds on to a view at that point, the old
+    buffer is left untouched and a fresh bytearray is allocated instead.
+
+    instance variables:
+        delimiter - the single byte that starts every frame
+        buffer    - the bytearray holding any unconsumed data
+        start     - the offset of the first unconsumed byte in buffer
+        synced    - whether or not a delimiter has been seen yet. Any data
+                    before the first delimiter is an incomplete frame and is
+                    discarded.
+    """
+    def __init__(self, delimiter=chr(START_BYTE)):
+        self.delimiter = delimiter
+        self.buffer = bytearray()
+        self.start = 0
+        self.synced = False
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    def extend(self, data):
+        "Discards any consumed data and appends data to the buffer"
+        try:
+            if self.start:
+                del self.buffer[:self.start]
+            self.buffer.extend(data)
+        except BufferError:
+            #Somebody is still holding a frame view into the old buffer
+            self.buffer = self.buffer[self.start:] + data
+        self.start = 0
+
+    def frames(self):
+        "Returns a list of memoryviews for every complete frame in the buffer"
+        buf = self.buffer
+        delimiter = self.delimiter
+        end = len(buf)
+
+        index = buf.find(delimiter, self.start)
+        if index == -1:
+            if not self.synced:
+                self.start = end
+            return []
+        if not self.synced:
+            self.synced = True
+            self.start = index
+
+        view = memoryview(buf)
+        frames = []
+        #self.start always points at a delimiter once we're synced
+        begin = self.start + 1
+        index = buf.find(delimiter, begin)
+        while index != -1:
+            if index > begin:
+                frames.append(view[begin:index])
+            begin = index + 1
+            index = buf.find(delimiter, begin)
+        self.start = begin - 1
+        return frames
+
+    def clear(self):
+        self.buffer = bytearray()
+        self.start = 0
+        self.synced = False
 
 class TransparentStream:
     """
-    Handles unescaping the escaped serial data stream and finding message
-    boundaries.
+    Handles finding message boundaries in the escaped serial data stream and
+    unescaping each message.
+
+    If fanout is set to a FanoutServer, every decoded sample is also
+    published to it.
     """
     START_BYTE = 0xE7
     ESCAPE_BYTE = 0x75
 
     START_CHAR = chr(START_BYTE)
+    ESCAPE_CHAR = chr(ESCAPE_BYTE)
     def __init__(self, decoder, logger, port):
         self.decoder = decoder
         self.stream_decoder = TransparentStreamDecoder()
         self.logger = logger
 
-        self.buffer = ""
+        self.buffer = FrameBuffer(self.START_CHAR)
 
         self.port = port
 
         self.data_table = {}
-        self.msg_queue = PriorityQueue()
+        self.msg_queue = deque()
+        self.fanout = None
 
     def start(self):
         pass
 
     def read(self):
-        self.buffer += self.stream_decoder.decode(self.port.read(4096))
+        self.buffer.extend(self.port.read(4096))
+
+    def unescape(self, frame):
+        "Returns the contents of a complete frame from the buffer"
+        packet = frame.tobytes()
+        if self.ESCAPE_CHAR not in packet:
+            return packet
+        #A frame never continues past the next start byte, so whatever
+        #state the last frame left the decoder in doesn't carry over
+        self.stream_decoder.reset()
+        return self.stream_decoder.decode(packet, final=True)
+
     def process(self):
         self.read()
-        if self.buffer.count(self.START_CHAR) < 2:
-            return
-
-        packets = []
-
-        self.buffer = self.buffer[self.buffer.index(self.START_CHAR)+1:]
-        index = self.buffer.index(self.START_CHAR)
-        while self.START_CHAR in self.buffer:
-            packets.append(self.buffer[:index])
-            self.buffer = self.buffer[index+1:]
+        packets = self.buffer.frames()
 
         for packet in packets:
             try:
+                packet = self.unescape(packet)
                 ts, id_, descr, data = self.decoder.decode(packet)
             except ValueError as e:
                 print "Error while decoding packet '%s': %s" % (''.join([hex(ord(c)) for c in packet]), e)
             except BaseException as e:
                 print "Unexpected error occured while decoding packet '%s': %s" % (''.join([hex(ord(c)) for c in packet]), e)
-            else:                
-                for msg_descr, datum in zip(descr["messages"], data):
-                    ident = "%#x:%s" % (id_, msg_descr[0])
+            else:
+                layout = self.decoder.layouts[id_]
+                for ident, msg_descr, datum in zip(layout.identifiers, descr["messages"], data):
                     self.put_data(ident, (ts, datum), msg_descr)
-                    self.msg_queue.put((id_, msg_descr[0], ts, datum))
-                    self.logger.info("%s: Got packet %s = %s", ts.strftime("%H:%M:%S"), ident, datum)
+                    self.msg_queue.append((id_, msg_descr[0], ts, datum))
+                #Formatted by the logger only if it isn't rate limited
+                self.logger.info("%s: Got packet %#x %s = %s", ts.time(), id_,
+                                 layout.names, data, extra={"source": "%#x" % id_})
 
     def put_data(self, identifier, datum, desc=None):
         if identifier not in self.data_table:
             self.data_table[identifier] = DataSource(identifier, desc)
         self.data_table[identifier].put(datum)
+        if self.fanout is not None:
+            self.fanout.publish(identifier, *datum)
 
     def get_data(self, identifier):
         if identifier not in self.data_table:
@@ -434,7 +639,7 @@ class XOMBIEStream:
         self.state = XOMBIEStream.UNASSOCIATED
 
         self.data_table = {}
-        self.msg_queue = PriorityQueue()
+        self.msg_queue = deque()
         self.name = name
         self.next_frame_id = 1
 
@@ -549,10 +754,10 @@ class XOMBIEStream:
                         return
                     for (offset, id_, desc, data) in messages:
                         dt = datetime.timedelta(seconds=(offset - self.rel_start)/1000.0)
-                        for msg_desc, datum in zip(desc["messages"], data):
-                            ident = "%#x:%s" % (id_, msg_desc[0])
+                        layout = self.decoder.layouts[id_]
+                        for ident, msg_desc, datum in zip(layout.identifiers, desc["messages"], data):
                             self.put_data(ident, (self.abs_start+dt, datum), msg_desc)
-                            self.msg_queue.put((id_, msg_desc[0], self.abs_start+dt, datum))
+                            self.msg_queue.append((id_, msg_desc[0], self.abs_start+dt, datum))
                             #self.logger.info("Got packet %s = %s", ident, datum)
         elif frame["id"] == "tx_status" or "frame_id" in frame:
             (frame_id,) = struct.unpack(">B", frame["frame_id"])
@@ -0,0 +1,400 @@
+"""
+Runs serial ingest and database logging in a separate process.
+
+Decoding packets and logging them to SQLite share the GIL with matplotlib
+when they run on a thread of the viewer, so a slow redraw can hold up the
+serial port long enough for its buffer to overflow. IngestProcess moves the
+TransparentStream and DatabaseWriter into a child process instead. The child
+publishes every decoded sample into SharedRings, a memory-mapped file with a
+fixed-size ring buffer per signal, and the viewer reads them back through
+SharedDataSources, which behave like any other DataSource.
+
+Each ring has a single writer. A sample is stored before the ring's count is
+bumped, so a reader only ever sees complete samples, and a reader that falls
+more than a ring behind skips ahead and counts the samples it missed.
+"""
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import time
+import Queue
+
+import numpy as np
+
+import serial
+
+from database import DatabaseWriter
+from fanout import FanoutServer
+from logs import RateLimiter, message_source
+from replay import CaptureRecorder, ReplayPort
+from GraphData import NaN, to_epoch, from_epoch
+from sample import DataSource, TransparentMessageDecoder, TransparentStream
+
+__all__ = ["SharedRings", "SharedDataSource", "IngestProcess"]
+
+class SharedRings(object):
+    """
+    A memory-mapped file holding one ring of (epoch seconds, value) samples
+    per signal.
+
+    The file starts with a header giving the number of slots, the capacity
+    of each ring and how many slots are in use, followed by a directory of
+    (identifier, count) entries, one per slot, and then the rings. count is
+    the total number of samples ever written to the slot's ring.
+
+    Identifiers are stored UTF-8 encoded in NAME_SIZE bytes, so longer
+    identifiers can't be given a slot.
+
+    instance variables:
+        path     - the file the rings are mapped from
+        slots    - the maximum number of signals
+        capacity - the number of samples each ring holds
+        index    - a mapping from signal identifiers to slots, for the
+                   slots seen so far
+    """
+    MAGIC = "CALSOLB1"
+    HEADER = struct.Struct("<8sIIQ")
+    NAME_SIZE = 64
+    DIRECTORY = np.dtype([("name", "S%d" % NAME_SIZE), ("count", "<u8")])
+    SAMPLE = np.dtype("<f8")
+
+    def __init__(self, path, slots=256, capacity=4096, create=False):
+        self.path = path
+        if create:
+            size = self.file_size(slots, capacity)
+            with open(path, "wb") as f:
+                f.truncate(size)
+            self.file = open(path, "r+b")
+            self.map = mmap.mmap(self.file.fileno(), size)
+            self.map[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, slots, capacity, 0)
+        else:
+            self.file = open(path, "r+b")
+            header = self.file.read(self.HEADER.size)
+            magic, slots, capacity, used = self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                raise ValueError("%s isn't a shared ring file" % path)
+            self.map = mmap.mmap(self.file.fileno(), self.file_size(slots, capacity))
+
+        self.slots = slots
+        self.capacity = capacity
+        self.index = {}
+        self.used = np.ndarray((), "<u8", self.map, self.HEADER.size - 8)
+        self.directory = np.ndarray((slots,), self.DIRECTORY, self.map,
+                                    self.HEADER.size)
+        self.counts = self.directory["count"]
+        self.rings = np.ndarray((slots, capacity, 2), self.SAMPLE, self.map,
+                                self.HEADER.size + slots * self.DIRECTORY.itemsize)
+
+    @classmethod
+    def file_size(cls, slots, capacity):
+        return (cls.HEADER.size + slots * cls.DIRECTORY.itemsize
+                + slots * capacity * 2 * cls.SAMPLE.itemsize)
+
+    def close(self):
+        self.used = self.directory = self.counts = self.rings = None
+        self.map.close()
+        self.file.close()
+
+    @staticmethod
+    def name(identifier):
+        "Returns identifier as it's stored in the directory"
+        if isinstance(identifier, unicode):
+            return identifier.encode("utf-8")
+        return identifier
+
+    def slot(self, identifier):
+        """
+        Returns the slot for identifier, assigning the next free one if
+        needed. Raises ValueError if the identifier is too long or there are
+        no free slots left.
+        """
+        name = self.name(identifier)
+        slot = self.index.get(name)
+        if slot is None:
+            if len(name) > self.NAME_SIZE:
+                raise ValueError("%s is longer than %d bytes" % (identifier, self.NAME_SIZE))
+            slot = int(self.used)
+            if slot >= self.slots:
+                raise ValueError("No free slots left for %s" % identifier)
+            self.directory[slot] = (name, 0)
+            #Only publish the slot once its name is in place
+            self.used[()] = slot + 1
+            self.index[name] = slot
+        return slot
+
+    def find(self, identifier):
+        "Returns the slot identifier was assigned, or None if it has none yet"
+        name = self.name(identifier)
+        if name not in self.index:
+            names = self.directory["name"]
+            for slot in xrange(len(self.index), int(self.used)):
+                self.index[names[slot]] = slot
+        return self.index.get(name)
+
+    def publish(self, identifier, t, value):
+        "Appends a sample to identifier's ring"
+        slot = self.slot(identifier)
+        count = int(self.counts[slot])
+        self.rings[slot, count % self.capacity] = (t, value)
+        self.counts[slot] = count + 1
+
+    def read(self, slot, since):
+        """
+        Returns (count, times, values, lost) for the samples written to slot
+        after the first since. lost is how many of those samples had
+        already been overwritten and are missing from times and values.
+        """
+        capacity = self.capacity
+        count = int(self.counts[slot])
+        start = max(since, count - capacity)
+        indices = np.arange(start, count) % capacity
+        samples = self.rings[slot, indices]
+
+        #The writer may have lapped us while we were copying. It overwrites
+        #a sample before bumping count, so with count at c the sample
+        #c - capacity may already be half overwritten.
+        oldest = int(self.counts[slot]) - capacity + 1
+        if oldest > start:
+            samples = samples[oldest - start:]
+            start = oldest
+        return count, samples[:, 0], samples[:, 1], start - since
+
+class SharedDataSource(DataSource):
+    """
+    A DataSource whose samples are published to SharedRings by another
+    process. pull copies whatever has been published since the last pull
+    into the GraphData; put isn't used.
+
+    instance variables:
+        rings    - the SharedRings the samples are read from
+        slot     - the slot of this source's ring, or None until the
+                   publisher has seen the signal
+        position - the number of samples of the ring read so far
+        lost     - the number of samples that were overwritten before they
+                   could be read
+    """
+    def __init__(self, identifier, rings, desc=None):
+        DataSource.__init__(self, identifier, desc)
+        self.rings = rings
+        self.slot = None
+        self.position = 0
+        self.lost = 0
+
+    def pull(self):
+        if self.slot is None:
+            self.slot = self.rings.find(self.name)
+            if self.slot is None:
+                return
+        count, times, values, lost = self.rings.read(self.slot, self.position)
+        self.position = count
+        self.lost += lost
+        added = 0
+        if len(times):
+            added = self.data.addPoints(zip(times.tolist(), values.tolist()))
+            self.last_received = max(self.last_received, from_epoch(times.max()))
+        added += self.data.release(time.time())
+        if added:
+            self.version += 1
+
+class QueueLogger(object):
+    """
+    A logger for the ingest process that passes messages back to the viewer.
+    Messages with a source are rate limited here, before they're formatted
+    and pickled, and summarize sends the summaries along.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        self.limiter = RateLimiter()
+
+    def summarize(self):
+        for line in self.limiter.summaries():
+            self.info("%s", line)
+
+    def log(self, level, msg, args, kwargs):
+        source = message_source(kwargs)
+        if source is not None and not self.limiter.allow(source):
+            return
+        formatted = (msg % kwargs) if kwargs else (msg % args)
+        try:
+            self.queue.put_nowait((level, formatted))
+        except Queue.Full:
+            pass
+
+    def info(self, msg, *args, **kwargs):
+        self.log("info", msg, args, kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log("warning", msg, args, kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log("error", msg, args, kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        self.log("critical", msg, args, kwargs)
+
+class PublishingStream(TransparentStream):
+    """
+    A TransparentStream that publishes samples to SharedRings. Signals that
+    can't be given a ring are logged once and then only written to the
+    database.
+    """
+    def __init__(self, decoder, logger, port, rings):
+        TransparentStream.__init__(self, decoder, logger, port)
+        self.rings = rings
+        self.unshared = set()
+
+    def put_data(self, identifier, datum, desc=None):
+        t, value = datum
+        if self.fanout is not None:
+            self.fanout.publish(identifier, t, value)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = NaN
+        if identifier in self.unshared:
+            return
+        try:
+            self.rings.publish(identifier, to_epoch(t), value)
+        except ValueError as e:
+            self.unshared.add(identifier)
+            self.logger.error("Can't show %s live: %s", identifier, e)
+
+def port_source(port):
+    """
+    Returns a (source, capture) pair that open_port can use to reopen port
+    in another process. port is closed.
+    """
+    capture = None
+    if isinstance(port, CaptureRecorder):
+        capture = port.path
+        inner = port.port
+    else:
+        inner = port
+    if isinstance(inner, ReplayPort):
+        source = ("replay", inner.path, inner.speed, inner.loop)
+    else:
+        source = ("serial", inner.portstr, inner.getSettingsDict())
+    port.close()
+    return source, capture
+
+def open_port(source, capture=None):
+    "Opens a port described by port_source"
+    if source[0] == "replay":
+        kind, path, speed, loop = source
+        port = ReplayPort(path, speed, loop)
+    else:
+        kind, name, settings = source
+        port = serial.Serial()
+        port.port = name
+        port.applySettingsDict(settings)
+        port.open()
+    if capture is not None:
+        port = CaptureRecorder(port, capture)
+    return port
+
+def run_ingest(rings_path, source, capture, database, mappings,
+               log_queue, stop, fanout_address=None, poll_interval=0.02):
+    """
+    The body of the ingest process. Decodes packets from the serial port
+    with the CAN descriptor mappings, publishes them to the rings (and to a
+    FanoutServer on fanout_address, if given) and logs them to the database
+    until stop is set.
+    """
+    logger = QueueLogger(log_queue)
+    rings = SharedRings(rings_path)
+    port = open_port(source, capture)
+    stream = PublishingStream(TransparentMessageDecoder(mappings), logger, port, rings)
+    writer = DatabaseWriter(database, logger)
+    writer.start()
+    if fanout_address is not None:
+        stream.fanout = FanoutServer(fanout_address, logger)
+        stream.fanout.start()
+    try:
+        while not stop.is_set():
+            stream.process()
+            writer.drain(stream.msg_queue)
+            logger.summarize()
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.drain(stream.msg_queue)
+        writer.close()
+        if stream.fanout is not None:
+            stream.fanout.close()
+        stream.close()
+        rings.close()
+
+class IngestProcess(object):
+    """
+    Starts run_ingest in a child process and stands in for its stream in
+    the viewer: get_data returns SharedDataSources, process forwards the
+    child's log messages, and close stops the child.
+
+    The serial port chosen in the viewer is closed and reopened by the
+    child with the same settings. Replay ports and capture recorders are
+    reopened on the same files. If fanout_address is given, the child
+    also runs a FanoutServer there.
+
+    By default there is a ring for every signal described in mappings.
+    """
+    def __init__(self, port, database, mappings, logger, fanout_address=None,
+                 slots=None, capacity=4096):
+        self.logger = logger
+        if slots is None:
+            layouts = TransparentMessageDecoder(mappings).layouts.values()
+            slots = max(1, sum(len(layout.identifiers) for layout in layouts))
+        fd, self.path = tempfile.mkstemp(prefix="telemetry-", suffix=".bus")
+        os.close(fd)
+        self.rings = SharedRings(self.path, slots, capacity, create=True)
+        self.data_table = {}
+
+        source, capture = port_source(port)
+        self.log_queue = multiprocessing.Queue(10000)
+        self.stop = multiprocessing.Event()
+        self.process_ = multiprocessing.Process(target=run_ingest,
+                                                name="Telemetry ingest",
+                                                args=(self.path, source, capture,
+                                                      database, mappings,
+                                                      self.log_queue, self.stop,
+                                                      fanout_address))
+        self.process_.daemon = True
+
+    def start(self):
+        self.process_.start()
+
+    @property
+    def lost(self):
+        return sum(source.lost for source in self.data_table.values())
+
+    def process(self):
+        "Copies log messages from the ingest process to the viewer's logger"
+        while True:
+            try:
+                level, msg = self.log_queue.get_nowait()
+            except Queue.Empty:
+                break
+            getattr(self.logger, level)("%s", msg)
+        if not self.process_.is_alive() and not self.stop.is_set():
+            self.stop.set()
+            self.logger.error("Ingest process exited with code %s",
+                              self.process_.exitcode)
+
+    def get_data(self, identifier):
+        if identifier not in self.data_table:
+            self.data_table[identifier] = SharedDataSource(identifier, self.rings)
+        return self.data_table[identifier]
+
+    def close(self):
+        self.stop.set()
+        if self.process_.is_alive():
+            self.process_.join()
+        self.process()
+        self.data_table.clear()
+        self.rings.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass